@@ -1,10 +1,8 @@
 import ast
 import dis
-from .executing import NotOneValueFound, only, function_node_types, assert_
+from .executing import NotOneValueFound, only, function_node_types, assert_, CodeCache, node_linenos, Source
 from ._exceptions import KnownIssue, VerifierFailure
 
-from functools import lru_cache
-
 # the code in this module can use all python>=3.11 features
 
 
@@ -63,9 +61,36 @@ def mangled_name(node):
     return name
 
 
-@lru_cache(128)
-def get_instructions(code):
-    return list(dis.get_instructions(code, show_caches=True))
+class InstructionTable:
+    """
+    The instructions of a code object in a compact form for lookups by offset,
+    see `get_instruction_table`.
+    The opcode of every code unit (including CACHE entries) is kept in a bytes object,
+    while `dis.Instruction` objects are only created for the real instructions.
+    """
+
+    def __init__(self, code):
+        # co_code has the CACHE entries zeroed, and opcode 0 is CACHE
+        self.opcodes = code.co_code[::2]
+        self.instructions = {inst.offset: inst for inst in dis.get_instructions(code)}
+
+    def opname(self, offset):
+        return dis.opname[self.opcodes[offset // 2]]
+
+    def instruction(self, offset):
+        return self.instructions[offset]
+
+
+# Limited by Source.instructions_cache_size
+instruction_tables = CodeCache()
+
+
+def get_instruction_table(code):
+    result = instruction_tables.get(code)
+    if result is None:
+        instruction_tables.maxsize = Source.instructions_cache_size
+        instruction_tables[code] = result = InstructionTable(code)
+    return result
 
 
 types_cmp_issue_fix = (
@@ -99,6 +124,201 @@ op_type_map = {
 }
 
 
+# Rules for `PositionNodeFinder.verify`, which checks that an ast-node could
+# have generated an instruction.
+# Maps an opname to a list of (node_types, check) pairs.
+# The node has to be an instance of node_types and check(node, instruction) has to be true,
+# where check can be None.
+# The table is filled in once at import time, see `verifier_rule`.
+verifier_rules = {}
+
+
+def verifier_rule(opnames, node_types, check=None):
+    if isinstance(opnames, str):
+        opnames = [opnames]
+    for opname in opnames:
+        verifier_rules.setdefault(opname, []).append((node_types, check))
+
+
+def is_str_mod(node):
+    # "..."%(...)
+    return (
+        isinstance(node.left, ast.Constant)
+        and isinstance(node.op, ast.Mod)
+        and isinstance(node.left.value, str)
+    )
+
+
+store_name_opnames = ("STORE_NAME", "STORE_FAST", "STORE_DEREF", "STORE_GLOBAL")
+
+verifier_rule("CACHE", ast.AST)
+
+# call to context.__exit__
+verifier_rule("CALL", (ast.With, ast.AsyncWith))
+
+# call to the generator function
+verifier_rule(
+    ("CALL", "LOAD_FAST"), (ast.ListComp, ast.GeneratorExp, ast.SetComp, ast.DictComp)
+)
+
+verifier_rule(("CALL", "CALL_FUNCTION_EX"), (ast.ClassDef, ast.Call))
+
+verifier_rule(("COMPARE_OP", "IS_OP", "CONTAINS_OP"), ast.Compare)
+
+verifier_rule(
+    "LOAD_NAME",
+    ast.AnnAssign,
+    lambda node, inst: inst.argval == "__annotations__",
+)
+
+# "..."%(...) uses "".join
+verifier_rule(
+    "LOAD_METHOD",
+    ast.BinOp,
+    lambda node, inst: inst.argval == "join" and is_str_mod(node),
+)
+verifier_rule(("CALL", "BUILD_STRING"), ast.BinOp, lambda node, inst: is_str_mod(node))
+
+# data: int
+verifier_rule("STORE_SUBSCR", ast.AnnAssign)
+
+verifier_rule(
+    store_name_opnames + ("DELETE_NAME", "DELETE_FAST", "DELETE_GLOBAL"),
+    ast.AST,
+    lambda node, inst: PositionNodeFinder.is_except_cleanup(inst, node),
+)
+
+verifier_rule(
+    ("DELETE_NAME", "DELETE_FAST"),
+    ast.Name,
+    lambda node, inst: node.id == inst.argval and isinstance(node.ctx, ast.Del),
+)
+
+verifier_rule("BUILD_STRING", ast.JoinedStr)
+verifier_rule("BUILD_STRING", ast.BinOp, lambda node, inst: isinstance(node.op, ast.Mod))
+
+verifier_rule(("BEFORE_WITH", "WITH_EXCEPT_START"), ast.With)
+
+# store docstrings
+verifier_rule(
+    ("STORE_NAME", "STORE_GLOBAL"),
+    ast.Constant,
+    lambda node, inst: inst.argval == "__doc__",
+)
+
+# store exception in variable
+verifier_rule(
+    store_name_opnames,
+    ast.ExceptHandler,
+    lambda node, inst: inst.argval == mangled_name(node),
+)
+
+# store imported module in variable
+verifier_rule(
+    store_name_opnames,
+    (ast.Import, ast.ImportFrom),
+    lambda node, inst: any(mangled_name(alias) == inst.argval for alias in node.names),
+)
+
+verifier_rule(
+    store_name_opnames,
+    (ast.FunctionDef, ast.ClassDef, ast.AsyncFunctionDef),
+    lambda node, inst: inst.argval == mangled_name(node),
+)
+verifier_rule(
+    store_name_opnames,
+    ast.Name,
+    lambda node, inst: isinstance(node.ctx, ast.Store)
+    and inst.argval == mangled_name(node),
+)
+
+# TODO: match statements are not supported for now (MatchAs, MatchSequence, MatchValue)
+
+# a+=5
+verifier_rule(
+    "BINARY_OP",
+    ast.AugAssign,
+    lambda node, inst: isinstance(node.op, op_type_map[inst.argrepr.removesuffix("=")]),
+)
+
+verifier_rule(
+    "DELETE_ATTR",
+    ast.Attribute,
+    lambda node, inst: isinstance(node.ctx, ast.Del)
+    and inst.argval == mangled_name(node),
+)
+
+# and/or short circuit
+verifier_rule(("JUMP_IF_TRUE_OR_POP", "JUMP_IF_FALSE_OR_POP"), ast.BoolOp)
+
+verifier_rule(
+    "DELETE_SUBSCR", ast.Subscript, lambda node, inst: isinstance(node.ctx, ast.Del)
+)
+
+verifier_rule(
+    ("LOAD_NAME", "LOAD_FAST", "LOAD_GLOBAL"),
+    ast.Name,
+    lambda node, inst: isinstance(node.ctx, ast.Load)
+    and inst.argval == mangled_name(node),
+)
+
+verifier_rule(
+    ("DELETE_NAME", "DELETE_GLOBAL"),
+    ast.Name,
+    lambda node, inst: isinstance(node.ctx, ast.Del)
+    and inst.argval == mangled_name(node),
+)
+
+
+def old_verifier_rule(op_name):
+    """
+    The rule of the old verifier for `op_name`, which is checked after all other rules.
+    The ctx of the node is not checked for these rules.
+    """
+    if op_name.startswith(("BINARY_SUBSCR", "SLICE+")):
+        return ast.Subscript, None
+    elif op_name.startswith("BINARY_"):
+        return ast.BinOp, lambda node, inst: isinstance(
+            node.op, op_type_map[inst.argrepr]
+        )
+    elif op_name.startswith("UNARY_"):
+        op_type = dict(
+            UNARY_POSITIVE=ast.UAdd,
+            UNARY_NEGATIVE=ast.USub,
+            UNARY_NOT=ast.Not,
+            UNARY_INVERT=ast.Invert,
+        ).get(op_name)
+        if op_type is not None:
+            return ast.UnaryOp, lambda node, inst: isinstance(node.op, op_type)
+    elif op_name in ("LOAD_ATTR", "LOAD_METHOD", "LOOKUP_METHOD"):
+        return ast.Attribute, lambda node, inst: mangled_name(node) == inst.argval
+    elif op_name in (
+        "LOAD_NAME",
+        "LOAD_GLOBAL",
+        "LOAD_FAST",
+        "LOAD_DEREF",
+        "LOAD_CLASSDEREF",
+    ):
+        return ast.Name, lambda node, inst: node.id == inst.argval
+    elif op_name in ("COMPARE_OP", "IS_OP", "CONTAINS_OP"):
+        return ast.Compare, lambda node, inst: len(node.ops) == 1
+    elif op_name.startswith(("STORE_SLICE", "STORE_SUBSCR")):
+        return ast.Subscript, None
+    elif op_name.startswith("STORE_ATTR"):
+        return ast.Attribute, lambda node, inst: mangled_name(node) == inst.argval
+    return None
+
+
+def add_old_verifier_rules():
+    for op_name in dis.opmap:
+        rule = old_verifier_rule(op_name)
+        if rule is not None:
+            verifier_rule(op_name, *rule)
+
+
+add_old_verifier_rules()
+
+
 class PositionNodeFinder(object):
     """
     Mapping bytecode to ast-node based on the source positions, which where introduced in pyhon 3.11.
@@ -107,7 +327,8 @@ class PositionNodeFinder(object):
     """
 
     def __init__(self, frame, stmts, tree, lasti, source):
-        self.bc_list = get_instructions(frame.f_code)
+        self.code = frame.f_code
+        self.instruction_table = get_instruction_table(frame.f_code)
 
         self.source = source
         self.decorator = None
@@ -116,9 +337,26 @@ class PositionNodeFinder(object):
         while self.opname(lasti) == "CACHE":
             lasti -= 2
 
+        self.result = self.node_at(lasti)
+
+        # Validated in Source._code_results
+        verification = source.verification
+
+        if verification != "off":
+            self.known_issues(self.result, self.instruction(lasti))
+
+        self.test_for_decorator(self.result, lasti)
+
+        if self.decorator is None and verification == "full":
+            self.verify(self.result, self.instruction(lasti))
+
+    def node_at(self, lasti):
+        """
+        Returns the ast-node of the instruction at `lasti`, without any verification.
+        """
         try:
             # try to map with all match_positions
-            self.result = self.find_node(lasti)
+            return self.find_node(lasti)
         except NotOneValueFound:
             # LOAD_METHOD could load "".join for long "..."%(...) BinOps
             # this can only be associated by using all positions
@@ -142,61 +380,99 @@ class PositionNodeFinder(object):
             else:
                 raise
 
-            self.result = self.find_node(
+            return self.find_node(
                 lasti,
                 match_positions=("end_col_offset", "end_lineno"),
                 typ=typ,
             )
 
-        self.known_issues(self.result, self.instruction(lasti))
-
-        self.test_for_decorator(self.result, lasti)
-
-        if self.decorator is None:
-            self.verify(self.result, self.instruction(lasti))
-
     def test_for_decorator(self, node, index):
         if (
             isinstance(node.parent, (ast.ClassDef, function_node_types))
             and node in node.parent.decorator_list
         ):
-            node_func = node.parent
-
-            while True:
-                # the generated bytecode looks like follow:
+            cache = self.source._decorator_calls
+            decorator_calls = cache.get(self.code)
+            if decorator_calls is None:
+                cache.maxsize = Source.instructions_cache_size
+                cache[self.code] = decorator_calls = self.find_decorator_calls()
 
-                # index    opname
-                # ------------------
-                # index-4  PRECALL
-                # index-2  CACHE
-                # index    CALL        <- the call instruction
-                # ...      CACHE       some CACHE instructions
+            if decorator_calls.get(index, (None, None))[1] is node:
+                self.result, self.decorator = decorator_calls[index]
 
-                # maybe multiple other bytecode blocks for other decorators
-                # index-4  PRECALL
-                # index-2  CACHE
-                # index    CALL        <- index of the next loop
-                # ...      CACHE       some CACHE instructions
+    def find_decorator_calls(self):
+        """
+        Returns a dict mapping the offset of every CALL instruction in the code
+        which applies a decorator to a (decorated node, decorator node) pair.
+        It's computed once for each code object and cached in `Source._decorator_calls`.
+        """
+        # the generated bytecode looks like follow:
+
+        # index    opname
+        # ------------------
+        # index-4  PRECALL
+        # index-2  CACHE
+        # index    CALL        <- the call instruction
+        # ...      CACHE       some CACHE instructions
+
+        # maybe multiple other bytecode blocks for other decorators
+        # index-4  PRECALL
+        # index-2  CACHE
+        # index    CALL        <- the call instruction of the next decorator
+        # ...      CACHE       some CACHE instructions
+
+        # index+x  STORE_*     the ast-node of this instruction points to the decorated thing
+
+        # so the chain of calls is collected backwards from every STORE_* instruction
+        result = {}
+        for index, instruction in self.instruction_table.instructions.items():
+            if not instruction.opname.startswith("STORE_"):
+                continue
+
+            calls = []
+            call = self.previous_index(index)
+            while (
+                call >= 4
+                and self.opname(call) == "CALL"
+                and self.opname(call - 4) == "PRECALL"
+            ):
+                calls.append(call)
+                call = self.previous_index(call - 4)
 
-                # index+x  STORE_*     the ast-node of this instruction points to the decorated thing
+            if not calls:
+                continue
 
-                if self.opname(index - 4) != "PRECALL" or self.opname(index) != "CALL":
-                    break
+            try:
+                node_func = self.find_node(index)
+            except NotOneValueFound:
+                continue
 
-                index += 2
+            if not isinstance(node_func, (ast.ClassDef, function_node_types)):
+                continue
 
-                while self.opname(index) in ("CACHE", "EXTENDED_ARG"):
-                    index += 2
+            for call in calls:
+                try:
+                    decorator = self.node_at(call)
+                except NotOneValueFound:
+                    continue
 
                 if (
-                    self.opname(index).startswith("STORE_")
-                    and self.find_node(index) == node_func
+                    decorator.parent is node_func
+                    and decorator in node_func.decorator_list
                 ):
-                    self.result = node_func
-                    self.decorator = node
-                    return
+                    result[call] = (node_func, decorator)
 
-                index += 4
+        return result
+
+    def previous_index(self, index):
+        """
+        Returns the index of the instruction before `index`,
+        skipping its CACHE entries and any EXTENDED_ARG of the instruction at `index`.
+        """
+        index -= 2
+        while index >= 0 and self.opname(index) in ("CACHE", "EXTENDED_ARG"):
+            index -= 2
+        return index
 
     def known_issues(self, node, instruction):
         if instruction.opname in ("COMPARE_OP", "IS_OP", "CONTAINS_OP") and isinstance(
@@ -296,242 +572,16 @@ class PositionNodeFinder(object):
 
     def verify(self, node, instruction):
         """
-        checks if this node could gererate this instruction
+        checks if this node could gererate this instruction,
+        see `verifier_rules`
         """
 
-        op_name = instruction.opname
-        extra_filter = lambda e: True
-        ctx = type(None)
-
-        def inst_match(opnames, **kwargs):
-            """
-            match instruction
-
-            Parameters:
-                opnames: (str|Seq[str]): inst.opname has to be equal to or in `opname`
-                **kwargs: every arg has to match inst.arg
-
-            Returns:
-                True if all conditions match the instruction
-
-            """
-
-            if isinstance(opnames, str):
-                opnames = [opnames]
-            return instruction.opname in opnames and kwargs == {
-                k: getattr(instruction, k) for k in kwargs
-            }
-
-        def node_match(node_type, **kwargs):
-            """
-            match the ast-node
-
-            Parameters:
-                node_type: type of the node
-                **kwargs: every `arg` has to be equal `node.arg`
-                        or `node.arg` has to be an instance of `arg` if it is a type.
-            """
-            return isinstance(node, node_type) and all(
-                isinstance(getattr(node, k), v)
-                if isinstance(v, type)
-                else getattr(node, k) == v
-                for k, v in kwargs.items()
-            )
-
-        if op_name == "CACHE":
-            return
-
-        if inst_match("CALL") and node_match((ast.With, ast.AsyncWith)):
-            # call to context.__exit__
-            return
-
-        if inst_match(("CALL", "LOAD_FAST")) and node_match(
-            (ast.ListComp, ast.GeneratorExp, ast.SetComp, ast.DictComp)
-        ):
-            # call to the generator function
-            return
-
-        if inst_match(("CALL", "CALL_FUNCTION_EX")) and node_match(
-            (ast.ClassDef, ast.Call)
-        ):
-            return
-
-        if inst_match(("COMPARE_OP", "IS_OP", "CONTAINS_OP")) and node_match(
-            ast.Compare
-        ):
-            return
-
-        if inst_match("LOAD_NAME", argval="__annotations__") and node_match(
-            ast.AnnAssign
-        ):
-            return
-
-        if (
-            (
-                inst_match("LOAD_METHOD", argval="join")
-                or inst_match(("CALL", "BUILD_STRING"))
-            )
-            and node_match(ast.BinOp, left=ast.Constant, op=ast.Mod)
-            and isinstance(node.left.value, str)
-        ):
-            # "..."%(...) uses "".join
-            return
-
-        if inst_match("STORE_SUBSCR") and node_match(ast.AnnAssign):
-            # data: int
-            return
-
-        if self.is_except_cleanup(instruction, node):
-            return
-
-        if inst_match(("DELETE_NAME", "DELETE_FAST")) and node_match(
-            ast.Name, id=instruction.argval, ctx=ast.Del
-        ):
-            return
-
-        if inst_match("BUILD_STRING") and (
-            node_match(ast.JoinedStr) or node_match(ast.BinOp, op=ast.Mod)
-        ):
-            return
-
-        if inst_match(("BEFORE_WITH","WITH_EXCEPT_START")) and node_match(ast.With):
-            return
-
-        if inst_match(("STORE_NAME", "STORE_GLOBAL"), argval="__doc__") and node_match(
-            ast.Constant
-        ):
-            # store docstrings
-            return
-
-        if (
-            inst_match(("STORE_NAME", "STORE_FAST", "STORE_GLOBAL", "STORE_DEREF"))
-            and node_match(ast.ExceptHandler)
-            and instruction.argval == mangled_name(node)
-        ):
-            # store exception in variable
-            return
-
-        if (
-            inst_match(("STORE_NAME", "STORE_FAST", "STORE_DEREF", "STORE_GLOBAL"))
-            and node_match((ast.Import, ast.ImportFrom))
-            and any(mangled_name(alias) == instruction.argval for alias in node.names)
-        ):
-            # store imported module in variable
-            return
-
-        if (
-            inst_match(("STORE_FAST", "STORE_DEREF", "STORE_NAME", "STORE_GLOBAL"))
-            and (
-                node_match((ast.FunctionDef, ast.ClassDef, ast.AsyncFunctionDef))
-                or node_match(
-                    ast.Name,
-                    ctx=ast.Store,
-                )
-            )
-            and instruction.argval == mangled_name(node)
-        ):
-            return
-
-        if False:
-            # TODO: match expressions are not supported for now
-            if inst_match(("STORE_FAST", "STORE_NAME")) and node_match(
-                ast.MatchAs, name=instruction.argval
+        for node_types, check in verifier_rules.get(instruction.opname, ()):
+            if isinstance(node, node_types) and (
+                check is None or check(node, instruction)
             ):
                 return
 
-            if inst_match("COMPARE_OP", argval="==") and node_match(ast.MatchSequence):
-                return
-
-            if inst_match("COMPARE_OP", argval="==") and node_match(ast.MatchValue):
-                return
-
-        if inst_match("BINARY_OP") and node_match(
-            ast.AugAssign, op=op_type_map[instruction.argrepr.removesuffix("=")]
-        ):
-            # a+=5
-            return
-
-        if node_match(ast.Attribute, ctx=ast.Del) and inst_match(
-            "DELETE_ATTR", argval=mangled_name(node)
-        ):
-            return
-
-        if inst_match(("JUMP_IF_TRUE_OR_POP", "JUMP_IF_FALSE_OR_POP")) and node_match(
-            ast.BoolOp
-        ):
-            # and/or short circuit
-            return
-
-        if inst_match("DELETE_SUBSCR") and node_match(ast.Subscript, ctx=ast.Del):
-            return
-
-        if node_match(ast.Name, ctx=ast.Load) and inst_match(
-            ("LOAD_NAME", "LOAD_FAST", "LOAD_GLOBAL"), argval=mangled_name(node)
-        ):
-            return
-
-        if node_match(ast.Name, ctx=ast.Del) and inst_match(
-            ("DELETE_NAME", "DELETE_GLOBAL"), argval=mangled_name(node)
-        ):
-            return
-
-        # old verifier
-
-        typ = type(None)
-
-        if op_name.startswith(("BINARY_SUBSCR", "SLICE+")):
-            typ = ast.Subscript
-            ctx = ast.Load
-        elif op_name.startswith("BINARY_"):
-            typ = ast.BinOp
-            op_type = op_type_map[instruction.argrepr]
-            extra_filter = lambda e: isinstance(e.op, op_type)
-        elif op_name.startswith("UNARY_"):
-            typ = ast.UnaryOp
-            op_type = dict(
-                UNARY_POSITIVE=ast.UAdd,
-                UNARY_NEGATIVE=ast.USub,
-                UNARY_NOT=ast.Not,
-                UNARY_INVERT=ast.Invert,
-            )[op_name]
-            extra_filter = lambda e: isinstance(e.op, op_type)
-        elif op_name in ("LOAD_ATTR", "LOAD_METHOD", "LOOKUP_METHOD"):
-            typ = ast.Attribute
-            ctx = ast.Load
-            extra_filter = lambda e: mangled_name(e) == instruction.argval
-        elif op_name in (
-            "LOAD_NAME",
-            "LOAD_GLOBAL",
-            "LOAD_FAST",
-            "LOAD_DEREF",
-            "LOAD_CLASSDEREF",
-        ):
-            typ = ast.Name
-            ctx = ast.Load
-            extra_filter = lambda e: e.id == instruction.argval
-        elif op_name in ("COMPARE_OP", "IS_OP", "CONTAINS_OP"):
-            typ = ast.Compare
-            extra_filter = lambda e: len(e.ops) == 1
-        elif op_name.startswith(("STORE_SLICE", "STORE_SUBSCR")):
-            ctx = ast.Store
-            typ = ast.Subscript
-        elif op_name.startswith("STORE_ATTR"):
-            ctx = ast.Store
-            typ = ast.Attribute
-            extra_filter = lambda e: mangled_name(e) == instruction.argval
-
-        node_ctx = getattr(node, "ctx", None)
-
-        ctx_match = (
-            ctx is not type(None)
-            or not hasattr(node, "ctx")
-            or isinstance(node_ctx, ctx)
-        )
-
-        # check for old verifier
-        if isinstance(node, typ) and ctx_match and extra_filter(node):
-            return
-
         # generate error
 
         title = "ast.%s is not created from %s" % (
@@ -542,10 +592,10 @@ class PositionNodeFinder(object):
         raise VerifierFailure(title, node, instruction)
 
     def instruction(self, index):
-        return self.bc_list[index // 2]
+        return self.instruction_table.instruction(index)
 
     def opname(self, index):
-        return self.instruction(index).opname
+        return self.instruction_table.opname(index)
 
     def find_node(
         self,
@@ -555,9 +605,31 @@ class PositionNodeFinder(object):
     ):
         position = self.instruction(index).positions
 
+        # Narrow down the candidates with the indexes in Source where possible,
+        # the conditions below still apply.
+        if set(match_positions) == {"lineno", "end_lineno", "col_offset", "end_col_offset"}:
+            candidates = self.source._nodes_by_position.get(
+                (position.lineno, position.end_lineno, position.col_offset, position.end_col_offset),
+                (),
+            )
+        elif set(match_positions) == {"end_lineno", "end_col_offset"}:
+            by_type = self.source._nodes_by_end_position.get(
+                (position.end_lineno, position.end_col_offset), {}
+            )
+            candidates = [
+                node
+                for node_type, nodes in by_type.items()
+                if issubclass(node_type, typ)
+                for node in nodes
+                # Like _nodes_by_line
+                if position.lineno in node_linenos(node)
+            ]
+        else:
+            candidates = self.source._nodes_by_line[position.lineno]
+
         return only(
             node
-            for node in self.source._nodes_by_line[position.lineno]
+            for node in candidates
             if isinstance(node, typ)
             if not isinstance(node, ast.Expr)
             # matchvalue.value has the same positions as matchvalue themself, so we exclude ast.MatchValue
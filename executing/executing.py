@@ -24,20 +24,31 @@ SOFTWARE.
 
 import __future__
 import ast
+import atexit
 import dis
 import functools
+import hashlib
 import inspect
 import io
 import linecache
+import marshal
+import os
 import re
 import sys
+import tempfile
 import types
-from collections import defaultdict, namedtuple
-from copy import deepcopy
+import weakref
+from collections import OrderedDict, defaultdict, namedtuple
+from copy import copy, deepcopy
 from itertools import islice
 from operator import attrgetter
 from threading import RLock
 
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
 function_node_types = (ast.FunctionDef,)
 
 PY3 = sys.version_info[0] == 3
@@ -148,6 +159,11 @@ def get_instructions(co):
 
 TESTING = 0
 
+# The parser reuses a single instance of each of these node types
+# across all trees, e.g. every Load context is the same object.
+# Linking them to a parent would keep some tree alive forever.
+singleton_node_types = (ast.expr_context, ast.boolop, ast.operator, ast.unaryop, ast.cmpop)
+
 
 class NotOneValueFound(Exception):
     def __init__(self,msg,values=[]):
@@ -170,6 +186,217 @@ def only(it):
     return lst[0]
 
 
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+class LRUCache(object):
+    """
+    A mapping which holds at most `maxsize` items,
+    discarding the least recently used items first.
+    If `maxsize` is None the cache can grow without bound.
+    `maxsize` can be changed at any time and is applied on the next insertion.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        # Reinserting moves the key to the end, i.e. marks it as most recently used
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                try:
+                    self._data.popitem(last=False)
+                except KeyError:
+                    # Emptied by another thread
+                    break
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = self.misses = 0
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+
+class CodeCache(LRUCache):
+    """
+    An LRUCache keyed by code objects which doesn't keep them alive.
+    An item is discarded once its code object is garbage collected.
+    """
+
+    def __init__(self, maxsize=None):
+        LRUCache.__init__(self, maxsize)
+        # Garbage collection can happen while `_data` is being modified,
+        # e.g. when it allocates memory or in another thread,
+        # and modifying it again from the callback then could corrupt it.
+        # Meanwhile the keys of dead code objects are stored in `_dead`
+        # and only removed on the next insertion.
+        self._busy = []
+        self._dead = []
+
+    def get(self, code, default=None):
+        self._busy.append(True)
+        try:
+            entry = LRUCache.get(self, id(code))
+        finally:
+            self._busy.pop()
+        # The id of a dead code object may have been reused
+        # before the callback below had a chance to run
+        if entry is None or entry[0]() is not code:
+            return default
+        return entry[1]
+
+    def __setitem__(self, code, value):
+        key = id(code)
+        data = self._data
+        busy = self._busy
+        dead = self._dead
+        # Don't keep the cache alive, and ignore the callback
+        # if the cache is being garbage collected along with the code
+        cache_ref = weakref.ref(self)
+
+        def remove(ref):
+            if cache_ref() is None:
+                return
+            if busy:
+                dead.append((key, ref))
+                return
+            entry = data.get(key)
+            if entry is not None and entry[0] is ref:
+                data.pop(key, None)
+
+        busy.append(True)
+        try:
+            while dead:
+                dead_key, ref = dead.pop()
+                entry = data.get(dead_key)
+                if entry is not None and entry[0] is ref:
+                    data.pop(dead_key, None)
+            LRUCache.__setitem__(self, key, (weakref.ref(code, remove), value))
+        finally:
+            busy.pop()
+
+    def pop(self, code, default=None):
+        self._busy.append(True)
+        try:
+            entry = LRUCache.pop(self, id(code))
+        finally:
+            self._busy.pop()
+        if entry is None or entry[0]() is not code:
+            return default
+        return entry[1]
+
+    def clear(self):
+        self._busy.append(True)
+        try:
+            LRUCache.clear(self)
+            del self._dead[:]
+        finally:
+            self._busy.pop()
+
+
+class CodeInstructions(object):
+    """
+    The instructions of a code object and related facts about it,
+    see `get_code_instructions`.
+    """
+
+    def __init__(self, code):
+        self.instructions = list(get_instructions(code))
+        # Index in `instructions` by offset
+        self.indices = {inst.offset: i for i, inst in enumerate(self.instructions)}
+        # Whether the code looks like it was rewritten by pytest
+        self.is_pytest = any(
+            'pytest' in name.lower()
+            for group in [code.co_names, code.co_varnames]
+            for name in group
+        )
+        # Results of SentinelNodeFinder.clean_instructions by ignore_linenos
+        self.clean = {}
+
+
+# Limited by Source.instructions_cache_size
+code_instructions_cache = CodeCache()
+
+
+def get_code_instructions(code):
+    """
+    Returns a `CodeInstructions` for `code`, which is cached
+    so that repeated misses in the same code object don't disassemble it again.
+    """
+    result = code_instructions_cache.get(code)
+    if result is None:
+        code_instructions_cache.maxsize = Source.instructions_cache_size
+        code_instructions_cache[code] = result = CodeInstructions(code)
+    return result
+
+
+def cache_on_instance(func):
+    """
+    Like `cache` for methods, but stores the results on the instance
+    so that they are freed along with it.
+    """
+    attr = '_cache_' + func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args):
+        results = self.__dict__.get(attr)
+        if results is None:
+            results = self.__dict__.setdefault(attr, {})
+        if args in results:
+            return results[args]
+        result = results[args] = func(self, *args)
+        return result
+
+    return wrapper
+
+
+class cached_property(object):
+    """
+    Like `functools.cached_property`, which isn't available in all supported versions:
+    computes the attribute on first access and then stores it on the instance.
+    The computation holds the instance's `_lock`, so that concurrent first accesses
+    compute the value only once.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        with instance._lock:
+            # Another thread may have computed the value while we waited for the lock
+            try:
+                return instance.__dict__[self.name]
+            except KeyError:
+                result = instance.__dict__[self.name] = self.func(instance)
+                return result
+
+
 class Source(object):
     """
     The source code of a single file and associated metadata.
@@ -186,14 +413,80 @@ class Source(object):
         - text
         - lines
         - tree: AST parsed from text, or None if text is not valid Python
-            All nodes in the tree have an extra `parent` attribute
+            All nodes in the tree have an extra `parent` attribute,
+            except for contexts and operators such as ast.Load and ast.Add
+            which are shared between all trees.
+            The text is only parsed when something first needs the tree.
 
     Other methods of interest:
         - statements_at_line
         - asttokens
         - code_qualname
+        - executing_cache_info
+        - clear_executing_cache
+        - invalidate
+
+    Settings (class attributes, which can be overridden in a subclass):
+        - executing_cache_size: the maximum number of code objects for which
+            `executing` keeps results, discarding the least recently used first.
+            None means no limit. Results are also discarded as soon as their
+            code object is garbage collected.
+        - index_code_objects: if true, the first call to `executing` for a code object
+            identifies the nodes of all its instructions at once, so that later calls
+            for any instruction in the same code object are a single lookup.
+            Only has an effect in Python 3.11+. False by default.
+        - checkcache_interval: the minimum number of seconds between checks
+            (using `linecache.checkcache`, which stats the file) that a file hasn't changed
+            since its `Source` was created. 0 (the default) checks on every call to `for_filename`,
+            float('inf') checks only the first time, e.g. for deployments where files never change.
+            Use the classmethod `invalidate` to force a check.
+            Only the `source_cache_size` most recently checked files are remembered,
+            others are checked again on their next call.
+        - partial_parsing: if true, `executing` only parses the top-level statement
+            (e.g. a function or class definition) containing the code being executed,
+            instead of the whole file. The `source` of the returned `Executing` object
+            is then a separate `Source` for that region, in which the rest of the file
+            is blank. Falls back to the whole file for module-level code
+            and whenever the region can't be isolated reliably. False by default.
+        - disk_cache_dir: a directory in which to store the qualnames of each file
+            and the nodes identified by `executing`, so that other processes
+            can reuse them instead of identifying the nodes again.
+            The data is only reused for the same file contents and Python version.
+            It's rewritten when new nodes are identified, at most once a second
+            for nodes identified one at a time, and when the process exits.
+            None (the default) disables this.
+        - instructions_cache_size: the maximum number of code objects whose
+            disassembled instructions are kept for identifying more nodes later.
+            None means no limit. Unlike the other settings, the cache is shared
+            by all subclasses, so this is only read from `Source` itself. 1000 by default.
+        - source_cache_size: the number of most recently used files whose `Source`
+            is kept by `for_filename` even when nothing else uses it. Other Sources are
+            only kept while they're in use, e.g. by results in the executing cache,
+            so that exec'd code with unique filenames doesn't keep its Source forever.
+            None means no limit. 100 by default.
+        - verification: how much `executing` checks that the node it found
+            could really have produced the instruction being executed.
+            "full" (the default) checks everything, and no node is returned
+            if anything is unexpected.
+            "fast" skips these checks and only handles the known issues in the compiler,
+            either correcting the node or giving up. Instructions which aren't normally
+            supported (e.g. LOAD_CONST or PUSH_NULL) then also get the node at their position.
+            "off" also skips the known issues, so in those rare cases a wrong node is returned.
+            Nodes found with "fast" or "off" aren't stored in `disk_cache_dir`,
+            but nodes stored there by other processes are still used.
+            Only has an effect in Python 3.11+, but any other value makes `executing`
+            raise a ValueError in all versions.
     """
 
+    executing_cache_size = 1000
+    instructions_cache_size = 1000
+    source_cache_size = 100
+    verification = "full"
+    index_code_objects = False
+    checkcache_interval = 0
+    partial_parsing = False
+    disk_cache_dir = None
+
     def __init__(self, filename, lines):
         """
         Don't call this constructor, see the class docstring.
@@ -223,24 +516,229 @@ class Source(object):
                 for i, line in enumerate(lines)
             ])
 
-        self._nodes_by_line = defaultdict(list)
-        self.tree = None
-        self._qualnames = {}
+        self._ast_text = ast_text
+        self._lock = RLock()
+
+        # See _region_for_code
+        self._regions = {}
+        self._code_regions = {}
+        # The (start, end) lines of the file covered by this Source if it's a region
+        self._region = None
 
+        # See _unmodified_compilation
+        self._compilations = LRUCache(100)
+
+        # See _disk_cache_changed
+        self._disk_cache_saved = None
+
+        # See PositionNodeFinder.find_decorator_calls
+        self._decorator_calls = CodeCache()
+
+    @cached_property
+    def _parsed_tree(self):
+        """
+        The AST parsed from the text, or None if the text is not valid Python.
+        Unlike `tree`, accessing this doesn't set the `parent` attributes.
+        """
+        ast_text = self.__dict__.pop('_ast_text')
         try:
-            self.tree = ast.parse(ast_text, filename=filename)
+            return ast.parse(ast_text, filename=self.filename)
         except (SyntaxError, ValueError):
-            pass
-        else:
+            return None
+
+    @cached_property
+    def tree(self):
+        # Sets the parent attributes
+        self._statements
+        return self._parsed_tree
+
+    @cached_property
+    def _statements(self):
+        """
+        Maps each node to the statement containing it, see statement_containing_node.
+        Computing this also sets the `parent` attribute of every node.
+        """
+        statements = {}
+        tree = self._parsed_tree
+        if tree is None:
+            return statements
+
+        for node in ast.walk(tree):
+            # ast.walk is breadth first, so the parent's statement is already known
+            statement = statements.get(node)
+            for child in ast.iter_child_nodes(node):
+                if isinstance(child, singleton_node_types):
+                    continue
+                child.parent = node
+                if isinstance(child, ast.stmt):
+                    statements[child] = child
+                elif statement is not None:
+                    statements[child] = statement
+        return statements
+
+    @cached_property
+    def _nodes_by_line(self):
+        nodes_by_line = defaultdict(list)
+        if self.tree is not None:
             for node in ast.walk(self.tree):
-                for child in ast.iter_child_nodes(node):
-                    child.parent = node
                 for lineno in node_linenos(node):
-                    self._nodes_by_line[lineno].append(node)
+                    nodes_by_line[lineno].append(node)
+        return nodes_by_line
+
+    @cached_property
+    def _nodes_by_position(self):
+        """
+        The nodes in `tree` by (lineno, end_lineno, col_offset, end_col_offset).
+        Used by PositionNodeFinder in Python 3.11+.
+        """
+        result = defaultdict(list)
+        for node in self._walked_nodes:
+            if getattr(node, 'end_lineno', None) is not None:
+                result[node.lineno, node.end_lineno, node.col_offset, node.end_col_offset].append(node)
+        return result
+
+    @cached_property
+    def _nodes_by_end_position(self):
+        """
+        The nodes in `tree` by (end_lineno, end_col_offset), then by type.
+        Used by PositionNodeFinder in Python 3.11+ when the start of a node
+        doesn't match the positions of its instruction.
+        """
+        result = defaultdict(lambda: defaultdict(list))
+        for node in self._walked_nodes:
+            if getattr(node, 'end_lineno', None) is not None:
+                result[node.end_lineno, node.end_col_offset][type(node)].append(node)
+        return result
+
+    @cached_property
+    def _assert_linenos(self):
+        """
+        The lines of the assert statements in `tree`,
+        which pytest rewrites so their bytecode can't be compared.
+        """
+        return frozenset(assert_linenos(self.tree))
+
+    @cached_property
+    def _walked_nodes(self):
+        """
+        All the nodes in `tree` in the order of `ast.walk`,
+        which is how nodes are referred to in the disk cache.
+        """
+        return list(ast.walk(self.tree))
+
+    @cached_property
+    def _node_indices(self):
+        return {node: i for i, node in enumerate(self._walked_nodes)}
+
+    @cached_property
+    def _qualnames(self):
+        disk_cache = self._disk_cache
+        if disk_cache is not None and isinstance(disk_cache.get('qualnames'), dict):
+            return disk_cache['qualnames']
+
+        if self._parsed_tree is None:
+            return {}
+        visitor = QualnameVisitor()
+        visitor.visit(self._parsed_tree)
+        return visitor.qualnames
+
+    @cached_property
+    def _disk_cache(self):
+        """
+        The data stored for this file in `disk_cache_dir`, or None if that's not set.
+        The data is a dict with the keys:
+            - version: `disk_cache_version`. The stored data is ignored if this doesn't match.
+            - content_hash: a hash of `text`. The stored data is ignored if this doesn't match.
+            - qualnames: the value of `_qualnames`.
+            - codes: a dict mapping each code object (see `disk_cache_code_key`)
+                to a dict mapping offsets to (node, decorator) pairs,
+                where each node is an index into `_walked_nodes` (or None for the decorator).
+        """
+        if self.disk_cache_dir is None:
+            return None
+
+        content_hash = hashlib.sha1(self.text.encode('utf8', 'replace')).hexdigest()
+        try:
+            with open(self._disk_cache_path(), 'rb') as f:
+                data = marshal.load(f)
+        except Exception:
+            data = None
+
+        if not (
+            isinstance(data, dict)
+            and data.get('version') == disk_cache_version
+            and data.get('content_hash') == content_hash
+            and isinstance(data.get('codes'), dict)
+        ):
+            data = {'version': disk_cache_version, 'content_hash': content_hash, 'codes': {}}
+        return data
+
+    def _disk_cache_path(self):
+        # Files are only stored per filename and Python version so that
+        # changes to a file replace the old data instead of accumulating.
+        # Node indices depend on the version of the ast module.
+        # Each region of a file (see partial_parsing) has its own tree and so its own data.
+        key = '%s\0%s' % (self.filename, sys.version)
+        if self._region is not None:
+            key += '\0%s:%s' % self._region
+        return os.path.join(
+            self.disk_cache_dir,
+            hashlib.sha1(key.encode('utf8', 'replace')).hexdigest() + '.executing',
+        )
+
+    def _disk_cache_results(self, code):
+        """
+        Returns the dict of (node, decorator) pairs by offset stored for `code`
+        in the disk cache, or None if the disk cache is disabled.
+        """
+        disk_cache = self._disk_cache
+        if disk_cache is None:
+            return None
+        codes = disk_cache['codes']
+        key = disk_cache_code_key(code)
+        result = codes.setdefault(key, {})
+        if not isinstance(result, dict):
+            # Malformed data, e.g. from a corrupted file
+            result = codes[key] = {}
+        return result
 
-            visitor = QualnameVisitor()
-            visitor.visit(self.tree)
-            self._qualnames = visitor.qualnames
+    def _disk_cache_changed(self, save=False):
+        """
+        Called after new results are stored in `_disk_cache`.
+        Writes the file if `save` is true or if it hasn't been written
+        for `disk_cache_save_interval` seconds, since rewriting the whole file
+        for every identified node would be slow.
+        Otherwise the file is written later, at the latest when the process exits,
+        see `save_disk_caches`.
+        """
+        saved = self._disk_cache_saved
+        if save or saved is None or monotonic() - saved >= disk_cache_save_interval:
+            self._save_disk_cache()
+        else:
+            unsaved_disk_caches.add(self)
+
+    def _save_disk_cache(self):
+        """
+        Writes `_disk_cache` to `disk_cache_dir` atomically,
+        so that other processes never see a partially written file.
+        Errors are ignored since the disk cache is only an optimisation.
+        """
+        data = self._disk_cache
+        temp_path = None
+        with self._lock:
+            unsaved_disk_caches.discard(self)
+            self._disk_cache_saved = monotonic()
+            data['qualnames'] = self._qualnames
+            try:
+                if not os.path.isdir(self.disk_cache_dir):
+                    os.makedirs(self.disk_cache_dir)
+                fd, temp_path = tempfile.mkstemp(dir=self.disk_cache_dir)
+                with os.fdopen(fd, 'wb') as f:
+                    marshal.dump(data, f)
+                replace_file(temp_path, self._disk_cache_path())
+            except Exception:
+                if temp_path is not None and os.path.exists(temp_path):
+                    os.remove(temp_path)
 
     @classmethod
     def for_frame(cls, frame, use_cache=True):
@@ -262,30 +760,89 @@ class Source(object):
         def get_lines():
             return linecache.getlines(filename, module_globals)
 
-        # Save the current linecache entry, then ensure the cache is up to date.
-        entry = linecache.cache.get(filename)
-        linecache.checkcache(filename)
-        lines = get_lines()
-        if entry is not None and not lines:
-            # There was an entry, checkcache removed it, and nothing replaced it.
-            # This means the file wasn't simply changed (because the `lines` wouldn't be empty)
-            # but rather the file was found not to exist, probably because `filename` was fake.
-            # Restore the original entry so that we still have something.
-            linecache.cache[filename] = entry
+        if cls._should_checkcache(filename):
+            # Save the current linecache entry, then ensure the cache is up to date.
+            entry = linecache.cache.get(filename)
+            linecache.checkcache(filename)
+            lines = get_lines()
+            if entry is not None and not lines:
+                # There was an entry, checkcache removed it, and nothing replaced it.
+                # This means the file wasn't simply changed (because the `lines` wouldn't be empty)
+                # but rather the file was found not to exist, probably because `filename` was fake.
+                # Restore the original entry so that we still have something.
+                linecache.cache[filename] = entry
+                lines = get_lines()
+        else:
             lines = get_lines()
 
-        lines = tuple(lines)
         return cls._for_filename_and_lines(filename, lines)
 
+    @classmethod
+    def _should_checkcache(cls, filename):
+        """
+        Returns True if `for_filename` should check that the linecache entry
+        for `filename` is up to date, according to `checkcache_interval`.
+        """
+        interval = cls.checkcache_interval
+        if not interval:
+            return True
+
+        checked = cls._class_local('__checkcache_times', LRUCache())
+        checked.maxsize = cls.source_cache_size
+        now = monotonic()
+        last = checked.get(filename)
+        if last is not None and now - last < interval:
+            return False
+
+        checked[filename] = now
+        return True
+
+    @classmethod
+    def invalidate(cls, filename=None):
+        """
+        Makes the next call to `for_filename` check that the file is up to date,
+        regardless of `checkcache_interval`.
+        If `filename` is None, this applies to all files.
+        """
+        checked = cls._class_local('__checkcache_times', LRUCache())
+        if filename is None:
+            checked.clear()
+        else:
+            if isinstance(filename, Path):
+                filename = str(filename)
+            checked.pop(filename, None)
+
     @classmethod
     def _for_filename_and_lines(cls, filename, lines):
-        source_cache = cls._class_local('__source_cache_with_lines', {})
-        try:
-            return source_cache[(filename, lines)]
-        except KeyError:
-            pass
+        # Sources are only held weakly by filename, so that a Source is freed
+        # once nothing uses it, e.g. when the code objects of an exec'd module are gone
+        # and the results in the executing cache with them.
+        # The most recently used ones are also kept alive, see `source_cache_size`.
+        # Only the latest version of each file is kept, so that reloading a module
+        # doesn't keep the old Source alive once nothing else uses it
+        source_cache = cls.__dict__.get('__source_cache')
+        if source_cache is None:
+            source_cache = cls._class_local('__source_cache', weakref.WeakValueDictionary())
+            cls._class_local('__recent_sources', LRUCache())
+        recent_sources = cls.__dict__['__recent_sources']
+
+        result = source_cache.get(filename)
+        if result is not None:
+            # linecache returns the same list for as long as its entry is valid,
+            # so checking identity is enough in the common case.
+            # Otherwise the entry was reloaded, possibly with the same contents.
+            if result._linecache_lines is lines or result._linecache_lines == lines:
+                result._linecache_lines = lines
+            else:
+                result = None
+
+        if result is None:
+            result = cls(filename, lines)
+            result._linecache_lines = lines
+            source_cache[filename] = result
 
-        result = source_cache[(filename, lines)] = cls(filename, lines)
+        recent_sources.maxsize = cls.source_cache_size
+        recent_sources[filename] = result
         return result
 
     @classmethod
@@ -299,6 +856,161 @@ class Source(object):
         Returns an `Executing` object representing the operation
         currently executing in the given frame or traceback object.
         """
+        frame, lineno, lasti = cls._frame_position(frame_or_tb)
+        code_results = cls._code_results(frame)
+
+        args = code_results.get(lasti)
+        if not args:
+            source = cls._source_for_code(frame)
+            code_results[lasti] = args = source._executing_args(frame, lineno, lasti)
+
+        return Executing(frame, *args)
+
+    @classmethod
+    def executing_many(cls, frames_or_tracebacks):
+        """
+        Like `executing`, but for several frames or traceback objects at once,
+        e.g. a whole stack. Returns a list of `Executing` objects in the same order.
+
+        Inputs are grouped by code object, so that each code object
+        is only looked up once in the cache, along with its `Source` if needed.
+        """
+        positions = [cls._frame_position(f) for f in frames_or_tracebacks]
+        groups = defaultdict(list)
+        for i, (frame, _, _) in enumerate(positions):
+            groups[id(frame.f_code)].append(i)
+
+        result = [None] * len(positions)
+        for indices in groups.values():
+            code_results = cls._code_results(positions[indices[0]][0])
+            source = None
+            for i in indices:
+                frame, lineno, lasti = positions[i]
+                args = code_results.get(lasti)
+                if not args:
+                    if source is None:
+                        source = cls._source_for_code(frame)
+                    code_results[lasti] = args = source._executing_args(frame, lineno, lasti)
+                result[i] = Executing(frame, *args)
+
+        return result
+
+    @classmethod
+    def prewarm(cls, modules_or_filenames, executor=None):
+        """
+        Does the work of `executing` in advance for the given modules and/or filenames,
+        so that later calls only need to look up the results.
+        For a module, the nodes of all the instructions in its functions are identified,
+        including methods of its classes. Module-level code and class bodies aren't included
+        since their code objects are discarded once they've run.
+        For a filename, the file is compiled and the same is done for all of its code,
+        but those code objects aren't the ones that actually run,
+        so the results are only reused through `disk_cache_dir`.
+
+        If `executor` (e.g. a `concurrent.futures.ThreadPoolExecutor`) is given,
+        each module or filename is submitted to it separately
+        and a list of the resulting futures is returned.
+        A process pool only helps with filenames and `disk_cache_dir`.
+        Otherwise the work is done immediately and None is returned.
+
+        Results are still limited by `executing_cache_size`.
+        """
+        cls._check_verification()
+
+        if executor is None:
+            for module_or_filename in modules_or_filenames:
+                cls._prewarm_one(module_or_filename)
+            return None
+
+        return [
+            executor.submit(cls._prewarm_one, module_or_filename)
+            for module_or_filename in modules_or_filenames
+        ]
+
+    @classmethod
+    def _prewarm_one(cls, module_or_filename):
+        if isinstance(module_or_filename, types.ModuleType):
+            module = module_or_filename
+            module_globals = module.__dict__
+            codes = module_code_objects(module)
+            if not codes:
+                # At least parse the file
+                try:
+                    filename = inspect.getsourcefile(module)
+                except TypeError:  # built in
+                    filename = None
+                if filename:
+                    cls.for_filename(filename, module_globals).tree
+        else:
+            module_globals = {}
+            source = cls.for_filename(module_or_filename)
+            if not source.tree:
+                return
+            codes = walk_codes(compile(source.tree, source.filename, 'exec', dont_inherit=True))
+
+        for code in codes:
+            if sys.version_info >= (3, 11):
+                # A frame in the middle of a call reports an offset within the CACHE entries after it
+                instructions = dis.get_instructions(code, show_caches=True)
+            else:
+                instructions = get_code_instructions(code).instructions
+
+            frame = None
+            for inst in instructions:
+                if inst.opname == 'CACHE':
+                    # Identified the same way as the instruction the entry belongs to
+                    if frame is not None:
+                        cls._copy_results(frame, inst.offset)
+                    continue
+
+                frame = None
+                if sys.version_info >= (3, 11):
+                    lineno = inst.positions.lineno
+                else:
+                    lineno = inst.lineno
+                if not lineno:
+                    continue
+
+                frame = FakeFrame(code, inst.offset, lineno, module_globals)
+                try:
+                    cls.executing(frame)
+                except Exception:
+                    frame = None
+
+        # Write the results once rather than after every instruction
+        save_disk_caches()
+
+    @classmethod
+    def _check_verification(cls):
+        # Checked before identifying nodes rather than during,
+        # where errors are swallowed and every node would just be None
+        if cls.verification not in verification_levels:
+            raise ValueError("Unknown verification level %r" % (cls.verification,))
+
+    @classmethod
+    def _copy_results(cls, frame, offset):
+        """
+        Stores the results of `executing` for `frame` for another offset in the same code object,
+        including in the disk cache. See `_prewarm_one`.
+        """
+        code_results = cls._code_results(frame)
+        args = code_results.get(frame.f_lasti)
+        if not args:
+            return
+        code_results[offset] = args
+
+        source = args[0]
+        disk_results = source._disk_cache_results(frame.f_code)
+        if disk_results and frame.f_lasti in disk_results and offset not in disk_results:
+            with source._lock:
+                disk_results[offset] = disk_results[frame.f_lasti]
+            source._disk_cache_changed()
+
+    @staticmethod
+    def _frame_position(frame_or_tb):
+        """
+        Returns (frame, lineno, lasti) for the given frame or traceback object.
+        """
         if isinstance(frame_or_tb, types.TracebackType):
             # https://docs.python.org/3/reference/datamodel.html#traceback-objects
             # "tb_lineno gives the line number where the exception occurred;
@@ -308,47 +1020,288 @@ class Source(object):
             #  if the exception occurred in a try statement with no matching except clause
             #  or with a finally clause."
             tb = frame_or_tb
-            frame = tb.tb_frame
-            lineno = tb.tb_lineno
-            lasti = tb.tb_lasti
+            return tb.tb_frame, tb.tb_lineno, tb.tb_lasti
         else:
             frame = frame_or_tb
-            lineno = frame.f_lineno
-            lasti = frame.f_lasti
-
+            return frame, frame.f_lineno, frame.f_lasti
 
+    @classmethod
+    def _code_results(cls, frame):
+        """
+        Returns the dict of cached arguments for `Executing` by offset
+        for the code object of `frame`, creating it if needed.
+        """
+        cls._check_verification()
 
         code = frame.f_code
-        key = (code, id(code), lasti)
-        executing_cache = cls._class_local('__executing_cache', {})
+        executing_cache = cls._executing_cache()
 
-        args = executing_cache.get(key)
-        if not args:
-            node = stmts = decorator = None
-            source = cls.for_frame(frame)
-            tree = source.tree
-            if tree:
+        code_results = executing_cache.get(code)
+        if code_results is None:
+            executing_cache.maxsize = cls.executing_cache_size
+            executing_cache[code] = code_results = {}
+            if cls.index_code_objects and sys.version_info >= (3, 11):
+                cls._source_for_code(frame)._index_code(frame, code_results)
+
+        return code_results
+
+    @classmethod
+    def _source_for_code(cls, frame):
+        """
+        Returns the `Source` used to identify nodes in `frame.f_code`,
+        which is only part of the file if `partial_parsing` is enabled.
+        """
+        source = cls.for_frame(frame)
+        if cls.partial_parsing:
+            source = source._region_for_code(frame.f_code)
+        return source
+
+    def _region_for_code(self, code):
+        """
+        Returns a `Source` for just the top-level statement containing `code`,
+        or self if that region can't be isolated reliably. See `partial_parsing`.
+
+        Results are cached so that all the code objects within the same region
+        share one `Source` and thus one tree.
+        """
+        if code.co_name == '<module>':
+            return self
+
+        key = (code.co_firstlineno, code.co_name, code.co_code)
+        with self._lock:
+            result = self._code_regions.get(key)
+            if result is None:
+                result = self._code_regions[key] = self._find_region(code) or self
+        return result
+
+    def _find_region(self, code):
+        lines = self.lines
+        linenos = [lineno for _, lineno in dis.findlinestarts(code) if lineno]
+        first = code.co_firstlineno
+        last = max(linenos + [first])
+        if not 0 < first <= last <= len(lines):
+            return None
+
+        # Guess where the top-level statement starts and ends from the indentation.
+        # This can be fooled by e.g. multiline strings,
+        # which is why the region is checked below.
+        start = first - 1
+        while start > 0 and not is_statement_boundary(lines[start]):
+            start -= 1
+        while start > 0 and lines[start - 1].startswith('@'):
+            start -= 1
+        end = last
+        while end < len(lines) and not is_statement_boundary(lines[end]):
+            end += 1
+
+        region = self._regions.get((start, end))
+        if region is None:
+            # Blank lines in place of the rest of the file keep line numbers the same
+            region_lines = (
+                ['\n'] * start
+                + [line + '\n' for line in lines[start:end]]
+                + ['\n'] * (len(lines) - end)
+            )
+            region = self.__class__(self.filename, region_lines)
+            region._region = (start, end)
+            region._code_keys = set()
+            if region._parsed_tree is not None:
                 try:
-                    stmts = source.statements_at_line(lineno)
-                    if stmts:
-                        if is_ipython_cell_code(code):
-                            decorator, node = find_node_ipython(frame, lasti, stmts)
-                        else:
-                            node_finder = NodeFinder(frame, stmts, tree, lasti, source)
-                            node = node_finder.result
-                            decorator = node_finder.decorator
+                    module_code = compile_similar_to(region._parsed_tree, code)
                 except Exception:
-                    if TESTING:
-                        raise
+                    pass
+                else:
+                    region._code_keys = {
+                        (c.co_firstlineno, c.co_name, c.co_code)
+                        for c in walk_codes(module_code)
+                    }
+            self._regions[(start, end)] = region
+
+        # The region is only used if compiling it reproduces the original code exactly
+        if (code.co_firstlineno, code.co_name, code.co_code) in region._code_keys:
+            return region
+        return None
+
+    def _unmodified_compilation(self, node, matching_code):
+        """
+        Compiles `node` from `tree` like `compile_similar_to(node, matching_code)`,
+        wrapping it in a module if it's a statement.
+        Returns an index of the resulting code objects by (co_firstlineno, co_name).
 
-                if node:
-                    new_stmts = {statement_containing_node(node)}
+        The result only depends on the node and the compiler flags,
+        so it's cached for use by later calls with other code objects.
+        """
+        flags = future_flags & matching_code.co_flags
+        key = (node, flags)
+        with self._lock:
+            result = self._compilations.get(key)
+            if result is None:
+                root = node if isinstance(node, ast.Module) else wrap_in_module(node)
+                result = defaultdict(list)
+                for code in walk_codes(compile_similar_to(root, matching_code)):
+                    result[code.co_firstlineno, code.co_name].append(code)
+                self._compilations[key] = result
+        return result
+
+    def _executing_args(self, frame, lineno, lasti):
+        """
+        Returns the arguments for `Executing` after `frame`,
+        except for the frame itself.
+        """
+        disk_results = self._disk_cache_results(frame.f_code)
+        if disk_results and lasti in disk_results:
+            loaded = self._load_disk_result(disk_results[lasti])
+            if loaded:
+                node, decorator = loaded
+                return self, node, {self._statements[node]}, decorator
+
+        node = stmts = decorator = None
+        if self.tree:
+            try:
+                stmts = self.statements_at_line(lineno)
+                if stmts:
+                    decorator, node = self._find_node(frame, stmts, lasti)
+            except Exception:
+                if TESTING:
+                    raise
+
+            if node:
+                new_stmts = {self._statements[node]}
+                assert_(new_stmts <= stmts)
+                stmts = new_stmts
+
+                if disk_results is not None and self._store_disk_result(disk_results, lasti, node, decorator):
+                    self._disk_cache_changed()
+
+        return self, node, stmts, decorator
+
+    def _store_disk_result(self, disk_results, offset, node, decorator):
+        """
+        Stores the node identified at `offset` in `disk_results`, see `_disk_cache`.
+        Returns False if the nodes aren't part of `tree`, e.g. for IPython cells,
+        or if they weren't fully verified, since other processes may rely on them
+        with `verification = "full"`.
+        """
+        if self.verification != "full" and sys.version_info >= (3, 11):
+            return False
+
+        node_indices = self._node_indices
+        if node not in node_indices or (decorator is not None and decorator not in node_indices):
+            return False
+        with self._lock:
+            disk_results[offset] = (
+                node_indices[node],
+                None if decorator is None else node_indices[decorator],
+            )
+        return True
+
+    def _load_disk_result(self, result):
+        """
+        Returns the (node, decorator) pair stored by `_store_disk_result`,
+        or None if `result` is malformed, e.g. from a corrupted file,
+        in which case the node is identified as usual.
+        """
+        if not self.tree:
+            return None
+        try:
+            node_index, decorator_index = result
+        except (TypeError, ValueError):
+            return None
+
+        nodes = self._walked_nodes
+        indices = [node_index]
+        if decorator_index is not None:
+            indices.append(decorator_index)
+        if not all(isinstance(index, int) and 0 <= index < len(nodes) for index in indices):
+            return None
+
+        node = nodes[node_index]
+        if node not in self._statements:
+            return None
+        decorator = None if decorator_index is None else nodes[decorator_index]
+        return node, decorator
+
+    def _find_node(self, frame, stmts, lasti):
+        """
+        Returns a (decorator, node) pair for the instruction at `lasti` in `frame`.
+        Raises an exception if the node can't be identified.
+        """
+        if is_ipython_cell_code(frame.f_code):
+            return find_node_ipython(frame, lasti, stmts, self)
+
+        node_finder = NodeFinder(frame, stmts, self.tree, lasti, self)
+        return node_finder.decorator, node_finder.result
+
+    def _index_code(self, frame, code_results):
+        """
+        Identifies the nodes of all the instructions in `frame.f_code` at once
+        and stores the arguments for `Executing` in `code_results` by offset.
+        Instructions which can't be identified are left out,
+        so that `executing` handles them individually as usual.
+        Only used in Python 3.11+ where this doesn't require compiling anything.
+        """
+        if not self.tree:
+            return
+
+        disk_results = self._disk_cache_results(frame.f_code)
+        stored = False
+        args = None
+        # A frame in the middle of a call reports an offset within the CACHE entries after it
+        for inst in dis.get_instructions(frame.f_code, show_caches=True):
+            if inst.opname != 'CACHE':
+                args = None
+                lineno = inst.positions.lineno
+                if not lineno:
+                    continue
+
+                stmts = self.statements_at_line(lineno)
+                if not stmts:
+                    continue
+
+                try:
+                    decorator, node = self._find_node(frame, stmts, inst.offset)
+                    new_stmts = {self._statements[node]}
                     assert_(new_stmts <= stmts)
-                    stmts = new_stmts
+                except Exception:
+                    continue
 
-            executing_cache[key] = args = source, node, stmts, decorator
+                args = self, node, new_stmts, decorator
+            elif args is None:
+                continue
 
-        return Executing(frame, *args)
+            # CACHE entries get the results of the instruction they belong to
+            code_results[inst.offset] = args
+            if disk_results is not None and inst.offset not in disk_results:
+                stored |= self._store_disk_result(disk_results, inst.offset, args[1], args[3])
+
+        if stored:
+            self._disk_cache_changed(save=True)
+
+    @classmethod
+    def _executing_cache(cls):
+        # Avoid constructing a new cache on every call to _class_local
+        result = cls.__dict__.get('__executing_cache')
+        if result is None:
+            result = cls._class_local('__executing_cache', CodeCache(cls.executing_cache_size))
+        return result
+
+    @classmethod
+    def executing_cache_info(cls):
+        """
+        Returns a `CacheInfo(hits, misses, maxsize, currsize)` namedtuple
+        describing the cache used by `executing`, like `functools.lru_cache`.
+        The cache is keyed by code objects, so hits and misses are counted per lookup
+        of a code object and `maxsize` and `currsize` count code objects.
+        """
+        return cls._executing_cache().cache_info()
+
+    @classmethod
+    def clear_executing_cache(cls):
+        """
+        Discards all results cached by `executing` and resets the statistics
+        returned by `executing_cache_info`.
+        """
+        cls._executing_cache().clear()
 
     @classmethod
     def _class_local(cls, name, default):
@@ -361,7 +1314,7 @@ class Source(object):
         setattr(cls, name, result)
         return result
 
-    @cache
+    @cache_on_instance
     def statements_at_line(self, lineno):
         """
         Returns the statement nodes overlapping the given line.
@@ -376,12 +1329,12 @@ class Source(object):
         """
 
         return {
-            statement_containing_node(node)
+            self._statements[node]
             for node in
             self._nodes_by_line[lineno]
         }
 
-    @cache
+    @cache_on_instance
     def asttokens(self):
         """
         Returns an ASTTokens object for getting the source of specific AST nodes.
@@ -522,6 +1475,128 @@ future_flags = sum(
 )
 
 
+def walk_codes(code):
+    """
+    Yields `code` and all the code objects nested within it.
+    """
+    yield code
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            for inner in walk_codes(const):
+                yield inner
+
+
+def module_code_objects(module):
+    """
+    Returns the code objects of the functions defined in `module`,
+    including methods of its classes, and all the code objects nested within them.
+    """
+    result = []
+    seen = set()
+
+    def add(value):
+        if id(value) in seen:
+            return
+        seen.add(id(value))
+
+        if isinstance(value, (staticmethod, classmethod)):
+            add(value.__func__)
+        elif isinstance(value, property):
+            for func in (value.fget, value.fset, value.fdel):
+                add(func)
+        elif inspect.isclass(value):
+            if value.__module__ == module.__name__:
+                for attr in list(vars(value).values()):
+                    add(attr)
+        elif inspect.isfunction(value):
+            # Decorators may return functions defined elsewhere
+            if value.__globals__ is vars(module):
+                result.extend(walk_codes(value.__code__))
+            add(getattr(value, '__wrapped__', None))
+
+    for value in list(vars(module).values()):
+        add(value)
+    return result
+
+
+# The allowed values of Source.verification
+verification_levels = ("full", "fast", "off")
+
+# Stands in for a frame executing the instruction at `f_lasti`, see `Source.prewarm`
+FakeFrame = namedtuple('FakeFrame', 'f_code f_lasti f_lineno f_globals')
+
+
+statement_boundary_pattern = re.compile(r'(?!(else|elif|except|finally)\b)[^\s#)\]}]')
+
+
+def is_statement_boundary(line):
+    """
+    Returns True if `line` looks like the start of a top-level statement,
+    i.e. it's not indented and doesn't continue a previous statement.
+    """
+    return bool(statement_boundary_pattern.match(line))
+
+
+def disk_cache_code_key(code):
+    """
+    Identifies a code object in `Source._disk_cache`.
+    Offsets are only meaningful for the same bytecode, and code objects
+    with the same bytecode (e.g. two similar lambdas on one line)
+    are told apart by the rest of the key.
+    """
+    if sys.version_info >= (3, 10):
+        # Includes column offsets in 3.11+
+        linetable = code.co_linetable
+    else:
+        linetable = code.co_lnotab
+    # repr distinguishes constants which compare equal, e.g. 1 and 1.0.
+    # Nested code objects are left out since their reprs contain memory addresses.
+    consts = repr(tuple(
+        const for const in code.co_consts
+        if not isinstance(const, types.CodeType)
+    ))
+    return (
+        code.co_firstlineno,
+        code.co_name,
+        code.co_code,
+        linetable,
+        code.co_names,
+        code.co_varnames,
+        code.co_freevars,
+        consts,
+    )
+
+
+replace_file = getattr(os, 'replace', os.rename)
+
+# Stored in each file in disk_cache_dir, which is ignored if this doesn't match.
+# Increase when the format of Source._disk_cache or disk_cache_code_key changes.
+disk_cache_version = 1
+
+# The minimum number of seconds between writes of the disk cache of a file
+# while nodes are identified one at a time, see Source._disk_cache_changed
+disk_cache_save_interval = 1
+
+# Sources with results that haven't been written to disk_cache_dir yet
+unsaved_disk_caches = weakref.WeakSet()
+
+
+def save_disk_caches():
+    """
+    Writes the results of all Sources that haven't been written to disk_cache_dir yet.
+    Called when the process exits.
+    """
+    while True:
+        try:
+            source = unsaved_disk_caches.pop()
+        except KeyError:
+            break
+        source._save_disk_cache()
+
+
+atexit.register(save_disk_caches)
+
+
 def compile_similar_to(source, matching_code):
     return compile(
         source,
@@ -534,24 +1609,35 @@ def compile_similar_to(source, matching_code):
 
 sentinel = 'io8urthglkjdghvljusketgIYRFYUVGHFRTBGVHKGF78678957647698'
 
+attribute_load_opnames = frozenset(('LOAD_ATTR', 'LOAD_METHOD', 'LOOKUP_METHOD'))
+name_load_opnames = frozenset(('LOAD_NAME', 'LOAD_GLOBAL', 'LOAD_FAST', 'LOAD_DEREF', 'LOAD_CLASSDEREF'))
+
+# Nodes whose contents are compiled to a separate code object
+scope_node_types = (
+    ast.Lambda, ast.ClassDef, ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp
+) + function_node_types
+
 class SentinelNodeFinder(object):
     def __init__(self, frame, stmts, tree, lasti, source):
         assert_(stmts)
         self.frame = frame
         self.tree = tree
         self.code = code = frame.f_code
-        self.is_pytest = any(
-            'pytest' in name.lower()
-            for group in [code.co_names, code.co_varnames]
-            for name in group
-        )
+        self.is_pytest = get_code_instructions(code).is_pytest
 
         if self.is_pytest:
-            self.ignore_linenos = frozenset(assert_linenos(tree))
+            if tree is source.tree:
+                self.ignore_linenos = source._assert_linenos
+            else:
+                self.ignore_linenos = frozenset(assert_linenos(tree))
         else:
             self.ignore_linenos = frozenset()
 
         self.decorator = None
+        self.stmts = stmts
+        self.source = source
+        # See find_compile_root
+        self._compile_root = self._compile_root_node = None
 
         self.instruction = instruction = self.get_actual_current_instruction(lasti)
         op_name = instruction.opname
@@ -590,11 +1676,11 @@ class SentinelNodeFinder(object):
                 UNARY_INVERT=ast.Invert,
             )[op_name]
             extra_filter = lambda e: isinstance(e.op, op_type)
-        elif op_name in ('LOAD_ATTR', 'LOAD_METHOD', 'LOOKUP_METHOD'):
+        elif op_name in attribute_load_opnames:
             typ = ast.Attribute
             ctx = ast.Load
             extra_filter = lambda e: attr_names_match(e.attr, instruction.argval)
-        elif op_name in ('LOAD_NAME', 'LOAD_GLOBAL', 'LOAD_FAST', 'LOAD_DEREF', 'LOAD_CLASSDEREF'):
+        elif op_name in name_load_opnames:
             typ = ast.Name
             ctx = ast.Load
             if PY3 or instruction.argval:
@@ -612,29 +1698,37 @@ class SentinelNodeFinder(object):
         else:
             raise RuntimeError(op_name)
 
-        with lock:
-            exprs = {
-                node
-                for stmt in stmts
-                for node in ast.walk(stmt)
-                if isinstance(node, typ)
-                if isinstance(getattr(node, "ctx", None), ctx)
-                if extra_filter(node)
-                if statement_containing_node(node) == stmt
-            }
-
-            if ctx == ast.Store:
-                # No special bytecode tricks here.
-                # We can handle multiple assigned attributes with different names,
-                # but only one assigned subscript.
-                self.result = only(exprs)
-                return
+        exprs = {
+            node
+            for stmt in stmts
+            for node in ast.walk(stmt)
+            if isinstance(node, typ)
+            if isinstance(getattr(node, "ctx", None), ctx)
+            if extra_filter(node)
+            if source._statements[node] == stmt
+        }
 
-            matching = list(self.matching_nodes(exprs))
-            if not matching and typ == ast.Call:
-                self.find_decorator(stmts)
-            else:
-                self.result = only(matching)
+        if ctx == ast.Store:
+            # No special bytecode tricks here.
+            # We can handle multiple assigned attributes with different names,
+            # but only one assigned subscript.
+            self.result = only(exprs)
+            return
+
+        unique_load = self.find_unique_load(exprs)
+        if unique_load is not None and not TESTING:
+            self.result = unique_load
+            return
+
+        matching = list(self.matching_nodes(exprs))
+        if unique_load is not None:
+            # Check the shortcut against the full process in the tests
+            assert_(matching == [unique_load])
+
+        if not matching and typ == ast.Call:
+            self.find_decorator(stmts)
+        else:
+            self.result = only(matching)
 
     def find_decorator(self, stmts):
         stmt = only(stmts)
@@ -643,7 +1737,7 @@ class SentinelNodeFinder(object):
         assert_(decorators)
         line_instructions = [
             inst
-            for inst in self.clean_instructions(self.code)
+            for inst in self.code_clean_instructions()
             if inst.lineno == self.frame.f_lineno
         ]
         last_decorator_instruction_index = [
@@ -668,24 +1762,102 @@ class SentinelNodeFinder(object):
         self.decorator = decorator
         self.result = stmt
 
-    def clean_instructions(self, code):
+    def find_unique_load(self, exprs):
+        """
+        Returns the only candidate in `exprs` if the current instruction
+        (loading an attribute or name) certainly belongs to it, otherwise None.
+        This is the case when the instruction is the only one loading that name
+        on its line and the candidate is directly in the scope of the code,
+        so nothing needs to be compiled.
+        """
+        instruction = self.instruction
+        for opnames in (attribute_load_opnames, name_load_opnames):
+            if instruction.opname in opnames:
+                break
+        else:
+            return None
+
+        argval = instruction.argval
+        if (
+                self.is_pytest
+                or len(exprs) != 1
+                or not argval
+                # The compiler loads names like __enter__ and __class__ implicitly
+                or (argval.startswith('__') and argval.endswith('__'))
+        ):
+            return None
+
+        same_loads = [
+            inst
+            for inst in self.code_clean_instructions()
+            if inst.lineno == instruction.lineno
+            if inst.argval == argval
+            if inst.opname in opnames
+        ]
+        if len(same_loads) != 1:
+            return None
+
+        expr = only(exprs)
+        stmt = self.source._statements[expr]
+        node = expr
+        while True:
+            node = node.parent
+            if node is stmt:
+                break
+            # e.g. a lambda or comprehension, which has its own code
+            if isinstance(node, scope_node_types):
+                return None
+
+        while True:
+            node = getattr(node, 'parent', None)
+            if node is None:
+                name = '<module>'
+                break
+            if isinstance(node, (ast.ClassDef,) + function_node_types):
+                name = node.name
+                break
+
+        if name != self.code.co_name:
+            return None
+
+        return expr
+
+    def clean_instructions(self, code, instructions=None):
+        if instructions is None:
+            instructions = get_instructions(code)
         return [
             inst
-            for inst in get_instructions(code)
+            for inst in instructions
             if inst.opname not in ("EXTENDED_ARG", "NOP")
             if inst.lineno not in self.ignore_linenos
         ]
 
+    def code_clean_instructions(self):
+        """
+        Returns `clean_instructions(self.code)`, cached along with the code's instructions.
+        The result must not be modified.
+        """
+        code_instructions = get_code_instructions(self.code)
+        result = code_instructions.clean.get(self.ignore_linenos)
+        if result is None:
+            result = code_instructions.clean[self.ignore_linenos] = self.clean_instructions(
+                self.code, code_instructions.instructions
+            )
+        return result
+
     def get_original_clean_instructions(self):
-        result = self.clean_instructions(self.code)
+        result = list(self.code_clean_instructions())
 
         # pypy sometimes (when is not clear)
         # inserts JUMP_IF_NOT_DEBUG instructions in bytecode
         # If they're not present in our compiled instructions,
         # ignore them in the original bytecode
-        if not any(
+        if any(
+                inst.opname == "JUMP_IF_NOT_DEBUG"
+                for inst in result
+        ) and not any(
                 inst.opname == "JUMP_IF_NOT_DEBUG"
-                for inst in self.compile_instructions()
+                for inst in self.unmodified_instructions()
         ):
             result = [
                 inst for inst in result
@@ -701,20 +1873,16 @@ class SentinelNodeFinder(object):
             for i, inst in enumerate(original_instructions)
             if inst == self.instruction
         )
+
+        if len(exprs) > 1:
+            matching = self.matching_nodes_at_once(exprs, original_instructions, original_index)
+            if matching is not None:
+                for expr in matching:
+                    yield expr
+                return
+
         for expr_index, expr in enumerate(exprs):
-            setter = get_setter(expr)
-            # noinspection PyArgumentList
-            replacement = ast.BinOp(
-                left=expr,
-                op=ast.Pow(),
-                right=ast.Str(s=sentinel),
-            )
-            ast.fix_missing_locations(replacement)
-            setter(replacement)
-            try:
-                instructions = self.compile_instructions()
-            finally:
-                setter(expr)
+            instructions = self.compile_instructions({expr: sentinel})
 
             if sys.version_info >= (3, 10):
                 try:
@@ -775,12 +1943,126 @@ class SentinelNodeFinder(object):
 
                 yield expr
 
-    def compile_instructions(self):
-        module_code = compile_similar_to(self.tree, self.code)
+    def matching_nodes_at_once(self, exprs, original_instructions, original_index):
+        """
+        Like `matching_nodes`, but with a single compilation:
+        all the candidates are transformed at once, each with a distinct sentinel.
+        Returns a list of the matching nodes, or None if the result can't be trusted
+        because the instructions don't exactly match the original
+        once the sentinel instructions are removed.
+        In that case `matching_nodes` tries the candidates one at a time.
+        """
+        sentinels = {
+            '%s_%s' % (sentinel, expr_index): expr
+            for expr_index, expr in enumerate(exprs)
+        }
+        try:
+            instructions = self.compile_instructions({
+                expr: expr_sentinel
+                for expr_sentinel, expr in sentinels.items()
+            })
+        except Exception:
+            return None
+
+        matching = []
+        new_instructions = []
+        expect_power = False
+        for instruction in instructions:
+            if expect_power:
+                if instruction.opname != 'BINARY_POWER':
+                    return None
+                expect_power = False
+            elif isinstance(instruction.argval, str) and instruction.argval in sentinels:
+                # The instruction just before the sentinel belongs to the candidate
+                if len(new_instructions) - 1 == original_index:
+                    matching.append(sentinels[instruction.argval])
+                expect_power = True
+            else:
+                new_instructions.append(instruction)
+
+        if len(new_instructions) != len(original_instructions) or not all(
+                opnames_match(inst1, inst2)
+                for inst1, inst2 in zip(original_instructions, new_instructions)
+        ):
+            return None
+
+        return matching
+
+    def compile_instructions(self, sentinels):
+        """
+        Compiles the tree with each node in the dict `sentinels` replaced
+        by `node ** sentinels[node]` and returns the clean instructions
+        of the code object corresponding to `self.code`.
+        """
+        if self._compile_root is None:
+            self.find_compile_root()
+        module_code = compile_similar_to(with_sentinels(self._compile_root, sentinels), self.code)
         code = only(self.find_codes(module_code))
         return self.clean_instructions(code)
 
-    def find_codes(self, root_code):
+    def unmodified_instructions(self):
+        """
+        Like `compile_instructions` when no node has been modified,
+        which allows reusing the compilation from the Source when possible.
+        """
+        if self._compile_root is None:
+            self.find_compile_root()
+        if self._compile_root_node is None:
+            return self.compile_instructions({})
+
+        code_index = self.source._unmodified_compilation(self._compile_root_node, self.code)
+        code = only(self.find_codes_in_index(code_index))
+        return self.clean_instructions(code)
+
+    def find_compile_root(self):
+        """
+        Finds the smallest tree that can be compiled to reproduce `self.code`,
+        so that compiling modified versions is proportional to the size of the
+        enclosing function or class rather than the whole module.
+        Sets `_compile_root` to that tree, and `_compile_root_node` to the node
+        of the source's tree that it contains (for `Source._unmodified_compilation`),
+        or None if the tree doesn't belong to the source, e.g. for IPython cells.
+
+        Tries each function or class definition containing the statements,
+        from the innermost outwards, wrapped in its own module.
+        Compiling a definition on its own can change the code,
+        e.g. names from enclosing functions become globals,
+        so a definition is only used if the resulting code is equal to the original.
+        Otherwise falls back to the whole tree.
+        """
+        self._compile_root = self.tree
+        self._compile_root_node = self.tree if self.tree is self.source.tree else None
+        if self.code.co_name == '<module>' or self._compile_root_node is None:
+            return
+
+        node = next(iter(self.stmts))
+        while hasattr(node, 'parent'):
+            node = node.parent
+            if not isinstance(node, (ast.ClassDef,) + function_node_types):
+                continue
+
+            try:
+                code_index = self.source._unmodified_compilation(node, self.code)
+            except Exception:
+                continue
+            codes = self.find_codes_in_index(code_index)
+            if len(codes) == 1 and codes[0] == self.code:
+                self._compile_root = wrap_in_module(node)
+                self._compile_root_node = node
+                return
+
+    def find_codes_in_index(self, code_index):
+        """
+        Like `find_codes`, using an index from `Source._unmodified_compilation`
+        instead of searching through all the code objects.
+        """
+        return self.find_codes(None, code_index.get((self.code.co_firstlineno, self.code.co_name), ()))
+
+    def find_codes(self, root_code, candidates=None):
+        """
+        Returns the code objects within `root_code` (including itself) which match `self.code`.
+        If `candidates` is given, only those code objects are checked instead.
+        """
         checks = [
             attrgetter('co_firstlineno'),
             attrgetter('co_freevars'),
@@ -799,6 +2081,9 @@ class SentinelNodeFinder(object):
                 for f in checks
             )
 
+        if candidates is not None:
+            return [c for c in candidates if matches(c)]
+
         code_options = []
         if matches(root_code):
             code_options.append(root_code)
@@ -823,12 +2108,9 @@ class SentinelNodeFinder(object):
         # Don't use get_original_clean_instructions
         # because we need the actual instructions including
         # EXTENDED_ARG
-        instructions = list(get_instructions(self.code))
-        index = only(
-            i
-            for i, inst in enumerate(instructions)
-            if inst.offset == lasti
-        )
+        code_instructions = get_code_instructions(self.code)
+        instructions = code_instructions.instructions
+        index = code_instructions.indices[lasti]
 
         while True:
             instruction = instructions[index]
@@ -844,7 +2126,9 @@ def non_sentinel_instructions(instructions, start):
     instructions introduced by the sentinel transformation
     """
     skip_power = False
-    for i, inst in islice(enumerate(instructions), start, None):
+    # Indexing directly instead of using islice avoids iterating over the first `start` items
+    for i in range(start, len(instructions)):
+        inst = instructions[i]
         if inst.argval == sentinel:
             assert_(inst.opname == "LOAD_CONST")
             skip_power = True
@@ -861,7 +2145,10 @@ def walk_both_instructions(original_instructions, original_start, instructions,
     Yields matching indices and instructions from the new and original instructions,
     leaving out changes made by the sentinel transformation.
     """
-    original_iter = islice(enumerate(original_instructions), original_start, None)
+    original_iter = (
+        (i, original_instructions[i])
+        for i in range(original_start, len(original_instructions))
+    )
     new_iter = non_sentinel_instructions(instructions, start)
     inverted_comparison = False
     while True:
@@ -892,13 +2179,19 @@ def handle_jumps(instructions, original_instructions):
     In some other cases duplication found in `original_instructions`
     is replicated in `instructions`.
     """
+    # Where to continue checking from after each modification
+    original_start = new_start = 0
     while True:
         for original_i, original_inst, new_i, new_inst in walk_both_instructions(
-            original_instructions, 0, instructions, 0
+            original_instructions, original_start, instructions, new_start
         ):
             if opnames_match(original_inst, new_inst):
                 continue
 
+            # Instructions before new_i are unchanged by the modifications below
+            # (unless a jump goes backwards) so they don't need to be checked again
+            original_start, new_start = original_i, new_i
+
             if "JUMP" in new_inst.opname and "JUMP" not in original_inst.opname:
                 # Find where the new instruction is jumping to, ignoring
                 # instructions which have been copied in previous iterations
@@ -908,6 +2201,8 @@ def handle_jumps(instructions, original_instructions):
                     if inst.offset == new_inst.argval
                     and not getattr(inst, "_copied", False)
                 )
+                if start < new_i:
+                    original_start = new_start = 0
                 # Replace the jump instruction with the jumped to section of instructions
                 # That section may also be deleted if it's not similarly duplicated
                 # in original_instructions
@@ -928,7 +2223,7 @@ def handle_jumps(instructions, original_instructions):
                 instructions[new_i:new_i] = only(find_new_matching(orig_section, instructions))
 
             # instructions has been modified, the for loop can't sensibly continue
-            # Restart it from the beginning, checking for other issues
+            # Restart it, checking for other issues
             break
 
         else:  # No mismatched jumps found, we're done
@@ -941,7 +2236,12 @@ def find_new_matching(orig_section, instructions):
     The yielded sections include sentinel instructions, but these
     are ignored when checking for matches.
     """
+    first = orig_section[0]
     for start in range(len(instructions) - len(orig_section)):
+        # Quickly rule out most starting points before building the whole section
+        inst = instructions[start]
+        if inst.argval != sentinel and not sections_match([first], [inst]):
+            continue
         indices, dup_section = zip(
             *islice(
                 non_sentinel_instructions(instructions, start),
@@ -983,12 +2283,16 @@ def check_duplicates(original_i, orig_section, original_instructions):
     Returns True if a section of original_instructions starting somewhere other
     than original_i and matching orig_section is found, i.e. orig_section is duplicated.
     """
+    first = orig_section[0]
     for dup_start in range(len(original_instructions)):
         if dup_start == original_i:
             continue
-        dup_section = original_instructions[dup_start : dup_start + len(orig_section)]
-        if len(dup_section) < len(orig_section):
+        if dup_start + len(orig_section) > len(original_instructions):
             return False
+        # Quickly rule out most starting points before slicing
+        if not sections_match([first], [original_instructions[dup_start]]):
+            continue
+        dup_section = original_instructions[dup_start : dup_start + len(orig_section)]
         if sections_match(orig_section, dup_section):
             return True
 
@@ -1022,25 +2326,55 @@ def opnames_match(inst1, inst2):
     )
 
 
-def get_setter(node):
-    parent = node.parent
-    for name, field in ast.iter_fields(parent):
-        if field is node:
-            return lambda new_node: setattr(parent, name, new_node)
-        elif isinstance(field, list):
-            for i, item in enumerate(field):
-                if item is node:
-                    def setter(new_node):
-                        field[i] = new_node
+def with_sentinels(root, sentinels):
+    """
+    Returns a copy of the tree `root` in which each node in the dict `sentinels`
+    is replaced by `node ** sentinels[node]`, so that the node can be recognised in the bytecode.
 
-                    return setter
+    `root` itself is never modified, so other threads can use it at the same time.
+    Only the replaced nodes and their ancestors are copied (shallowly),
+    all other subtrees are shared with `root`.
+    """
+    # The nodes that need to be copied
+    path = {root}
+    for node in sentinels:
+        while node is not None and node not in path:
+            path.add(node)
+            node = getattr(node, 'parent', None)
+
+    def copy_node(node):
+        if node not in path:
+            return node
+
+        new_node = copy(node)
+        for name, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                value = [copy_node(item) for item in value]
+            elif isinstance(value, ast.AST):
+                value = copy_node(value)
+            setattr(new_node, name, value)
+
+        if node in sentinels:
+            # noinspection PyArgumentList
+            replacement = ast.BinOp(
+                op=ast.Pow(),
+                right=ast.Str(s=sentinels[node]),
+            )
+            ast.fix_missing_locations(replacement)
+            replacement.left = new_node
+            new_node = replacement
 
+        return new_node
 
-lock = RLock()
+    return copy_node(root)
 
 
-@cache
 def statement_containing_node(node):
+    """
+    Returns the closest ancestor of `node` which is a statement, or `node` itself.
+    `Source._statements` holds the same information for every node in `Source.tree`
+    and should be preferred when available.
+    """
     while not isinstance(node, ast.stmt):
         node = node.parent
     return node
@@ -1062,6 +2396,13 @@ def _extract_ipython_statement(stmt):
     # will find a code mismatch.
     while not isinstance(stmt.parent, ast.Module):
         stmt = stmt.parent
+    return wrap_in_module(stmt)
+
+
+def wrap_in_module(stmt):
+    """
+    Returns a new module whose body is just `stmt`, which keeps its location.
+    """
     # use `ast.parse` instead of `ast.Module` for better portability
     # python3.8 changes the signature of `ast.Module`
     # Inspired by https://github.com/pallets/werkzeug/pull/1552/files
@@ -4,15 +4,21 @@ from __future__ import print_function, division
 import ast
 import contextlib
 import dis
+import gc
 import inspect
 import json
+import linecache
+import marshal
 import os
 import re
+import shutil
 import sys
 import tempfile
+import threading
 import time
 import types
 import unittest
+import weakref
 from collections import defaultdict, namedtuple
 from random import shuffle
 
@@ -22,8 +28,10 @@ from tests.utils import tester, subscript_item, in_finally, start_position, end_
 
 PYPY = 'pypy' in sys.version.lower()
 
+import executing.executing
 from executing import Source, only, NotOneValueFound
-from executing.executing import PY3, get_instructions, function_node_types
+from executing.executing import PY3, get_instructions, get_code_instructions, function_node_types, \
+    SentinelNodeFinder, with_sentinels, wrap_in_module, save_disk_caches, walk_codes
 
 from executing._exceptions import VerifierFailure, KnownIssue
 
@@ -281,6 +289,535 @@ class TestStuff(unittest.TestCase):
                 self.assertIs(node, new_node)
         self.assertLess(time.time() - start, 1)
 
+    def test_code_instructions_cache(self):
+        code = compile('x = [y + 1 for y in z]', '<code_instructions>', 'exec')
+        code_instructions = get_code_instructions(code)
+        self.assertIs(get_code_instructions(code), code_instructions)
+        instructions = list(get_instructions(code))
+        self.assertEqual(code_instructions.instructions, instructions)
+        for i, inst in enumerate(instructions):
+            self.assertEqual(code_instructions.indices[inst.offset], i)
+        self.assertFalse(code_instructions.is_pytest)
+        self.assertTrue(get_code_instructions(compile('pytest_ar', '<pytest>', 'eval')).is_pytest)
+
+        code_ref = weakref.ref(code)
+        del code
+        gc.collect()
+        self.assertIsNone(code_ref())
+
+    def test_assert_linenos(self):
+        source = Source('<assert_linenos>', 'x = 1\nassert (x ==\n        1)\ny = 2\n')
+        linenos = source._assert_linenos
+        self.assertEqual(linenos, {2, 3})
+        self.assertIs(source._assert_linenos, linenos)
+
+    def test_nodes_by_position(self):
+        if sys.version_info < (3, 8):
+            return
+
+        source = Source('<nodes_by_position>', 'x = foo.bar(\n    1)\n')
+        call = source.tree.body[0].value
+        self.assertEqual(source._nodes_by_position[1, 2, 4, 6], [call])
+        by_type = source._nodes_by_end_position[2, 6]
+        self.assertEqual(by_type[ast.Call], [call])
+        self.assertEqual(source._nodes_by_end_position[1, 11][ast.Attribute], [call.func])
+
+    def test_instruction_table(self):
+        if sys.version_info < (3, 11):
+            return
+
+        from executing._position_node_finder import get_instruction_table, instruction_tables
+
+        code = compile('x = foo(y.z)', '<instruction_table>', 'exec')
+        table = get_instruction_table(code)
+        self.assertIs(get_instruction_table(code), table)
+        self.assertEqual(instruction_tables.maxsize, Source.instructions_cache_size)
+
+        all_instructions = list(dis.get_instructions(code, show_caches=True))
+        for inst in all_instructions:
+            self.assertEqual(table.opname(inst.offset), inst.opname)
+        self.assertEqual(
+            list(table.instructions.values()),
+            [inst for inst in all_instructions if inst.opname != 'CACHE'],
+        )
+
+    def test_verification(self):
+        if sys.version_info < (3, 11):
+            return
+
+        def get_node(verification):
+            class MySource(Source):
+                pass
+
+            MySource.verification = verification
+            frame = inspect.currentframe().f_back
+            push_null = only(
+                inst for inst in dis.get_instructions(frame.f_code)
+                if inst.opname == 'PUSH_NULL' and inst.positions.lineno == frame.f_lineno
+            )
+            frame_at = C()
+            frame_at.f_code = frame.f_code
+            frame_at.f_lasti = push_null.offset
+            frame_at.f_lineno = frame.f_lineno
+            frame_at.f_globals = globals()
+            return MySource.executing(frame_at).node
+
+        with self.assertRaises(VerifierFailure):
+            get_node("full")
+        self.assertIsInstance(get_node("fast"), ast.Name)
+        self.assertIsInstance(get_node("off"), ast.Name)
+        with self.assertRaises(ValueError):
+            get_node("none")
+
+    def test_invalid_verification(self):
+        class MySource(Source):
+            verification = "Full"
+
+        # Not swallowed like errors while identifying nodes
+        testing = executing.executing.TESTING
+        executing.executing.TESTING = False
+        try:
+            with self.assertRaises(ValueError):
+                MySource.executing(inspect.currentframe())
+            with self.assertRaises(ValueError):
+                MySource.executing_many([inspect.currentframe()])
+            with self.assertRaises(ValueError):
+                MySource.prewarm([])
+        finally:
+            executing.executing.TESTING = testing
+
+    def test_verifier_rules(self):
+        if sys.version_info < (3, 11):
+            return
+
+        from executing._position_node_finder import verifier_rules
+
+        pairs = set()
+        for opname, rules in verifier_rules.items():
+            self.assertIn(opname, dis.opmap)
+            for node_types, check in rules:
+                if not isinstance(node_types, tuple):
+                    node_types = (node_types,)
+                for node_type in node_types:
+                    self.assertTrue(issubclass(node_type, ast.AST))
+                    pairs.add((opname, node_type))
+
+        for pair in [
+            ("LOAD_ATTR", ast.Attribute),
+            ("LOAD_GLOBAL", ast.Name),
+            ("BINARY_SUBSCR", ast.Subscript),
+            ("BINARY_OP", ast.BinOp),
+            ("BINARY_OP", ast.AugAssign),
+            ("UNARY_NOT", ast.UnaryOp),
+            ("COMPARE_OP", ast.Compare),
+            ("CALL", ast.Call),
+            ("STORE_ATTR", ast.Attribute),
+            ("STORE_NAME", ast.FunctionDef),
+        ]:
+            self.assertIn(pair, pairs)
+        self.assertNotIn("PUSH_NULL", verifier_rules)
+        self.assertNotIn("LOAD_CONST", verifier_rules)
+
+    def test_executing_cache(self):
+        class MySource(Source):
+            executing_cache_size = 2
+
+        def current_node():
+            return MySource.executing(inspect.currentframe().f_back).node
+
+        def f1():
+            return current_node()
+
+        def f2():
+            return current_node()
+
+        def f3():
+            return current_node()
+
+        node = f1()
+        self.assertIs(node, f1())
+        f2()
+        f3()
+        info = MySource.executing_cache_info()
+        self.assertEqual(info.maxsize, 2)
+        self.assertEqual(info.currsize, 2)
+        self.assertEqual(Source.executing_cache_info().maxsize, 1000)
+
+        # The evicted result is found again, with the same node
+        self.assertIs(node, f1())
+
+        MySource.clear_executing_cache()
+        self.assertEqual(MySource.executing_cache_info(), (0, 0, 2, 0))
+        self.assertIs(node, f1())
+
+    def test_unique_load(self):
+        if sys.version_info >= (3, 11):
+            return
+
+        def func(x):
+            return foo(x.y, x.z.y, x.w) + (lambda: x.v)()  # noqa
+
+        found = {}
+        original = SentinelNodeFinder.find_unique_load
+
+        def find_unique_load(finder, exprs):
+            result = found[finder.instruction.argval] = original(finder, exprs)
+            return result
+
+        SentinelNodeFinder.find_unique_load = find_unique_load
+        try:
+            for code in [func.__code__, only(
+                    const for const in func.__code__.co_consts
+                    if isinstance(const, types.CodeType)
+            )]:
+                for inst in get_instructions(code):
+                    if inst.opname not in ('LOAD_ATTR', 'LOAD_METHOD', 'LOAD_GLOBAL', 'LOAD_FAST', 'LOAD_DEREF'):
+                        continue
+                    frame = C()
+                    frame.f_lasti = inst.offset
+                    frame.f_code = code
+                    frame.f_globals = globals()
+                    frame.f_lineno = inst.lineno
+                    Source.executing(frame)
+        finally:
+            SentinelNodeFinder.find_unique_load = original
+
+        # Loaded several times on the line
+        # (in Python 2 the name of LOAD_DEREF isn't known at all)
+        self.assertIsNone(found.get('x'))
+        self.assertIsNone(found['y'])
+        # Inside a lambda
+        self.assertIsNone(found['v'])
+
+        self.assertEqual(found['foo'].id, 'foo')
+        self.assertEqual(found['z'].attr, 'z')
+        self.assertEqual(found['w'].attr, 'w')
+
+    def test_with_sentinels(self):
+        source = Source('<with_sentinels>', 'def f(x):\n    return x.y.z + g(x)\nh()\n')
+        tree = source.tree
+        original_dump = ast.dump(tree)
+        func = tree.body[0]
+        binop = func.body[0].value
+        inner = binop.left.value
+        outer = binop.left
+        new_tree = with_sentinels(tree, {inner: 's1', outer: 's2'})
+
+        # Nothing in the source's tree was modified
+        self.assertEqual(ast.dump(tree), original_dump)
+        self.assertIs(binop.left, outer)
+        self.assertIs(outer.value, inner)
+
+        new_binop = new_tree.body[0].body[0].value
+        self.assertEqual(new_binop.left.right.s, 's2')
+        self.assertEqual(new_binop.left.left.value.right.s, 's1')
+        self.assertIs(new_binop.left.left.value.left.value, inner.value)
+
+        # Unchanged subtrees are shared
+        self.assertIs(new_tree.body[1], tree.body[1])
+        self.assertIs(new_tree.body[0].args, func.args)
+        self.assertIs(new_binop.right, binop.right)
+        compile(new_tree, '<with_sentinels>', 'exec')
+
+    def test_find_compile_root(self):
+        source = Source('<find_compile_root>', """\
+class Outer:
+    class Inner:
+        def method(self):
+            return self.a
+
+def closure():
+    y = 1
+    def uses_closure(x):
+        return x.a + y
+    return uses_closure
+
+class Mangled:
+    def method(self):
+        return self.__private
+
+module_lambda = lambda x: x.a
+
+def with_nested(xs):
+    return [x.a for x in xs], (lambda y: y.b)
+""")
+        tree = source.tree
+        module_code = compile(source.text, source.filename, 'exec')
+        codes = {(code.co_name, code.co_firstlineno): code for code in walk_codes(module_code)}
+
+        def compile_root(name, lineno, stmt_lineno=None):
+            finder = SentinelNodeFinder.__new__(SentinelNodeFinder)
+            finder.tree = tree
+            finder.source = source
+            finder.code = codes[name, lineno]
+            finder.stmts = source.statements_at_line(stmt_lineno or lineno + 1)
+            finder.is_pytest = False
+            finder.find_compile_root()
+            if finder._compile_root_node is tree:
+                self.assertIs(finder._compile_root, tree)
+            else:
+                self.assertIs(finder._compile_root.body[0], finder._compile_root_node)
+            return finder._compile_root_node
+
+        outer, closure, mangled, module_lambda, with_nested = tree.body
+
+        # The innermost definition that compiles to the same code
+        self.assertIs(compile_root('method', 3), outer.body[0].body[0])
+        self.assertIs(compile_root('Outer', 1), outer)
+
+        # On its own, y would be a global
+        self.assertIs(compile_root('uses_closure', 8), closure)
+        # On its own, the name wouldn't be mangled
+        self.assertIs(compile_root('method', 13), mangled)
+        # Not in any definition
+        self.assertIs(compile_root('<lambda>', 16, 16), tree)
+        self.assertIs(compile_root('<module>', 1), tree)
+
+        # Code objects within the definition are found through the index
+        self.assertIs(compile_root('<lambda>', 19, 19), with_nested)
+        if ('<listcomp>', 19) in codes:
+            self.assertIs(compile_root('<listcomp>', 19, 19), with_nested)
+
+    def test_matching_nodes_at_once(self):
+        if sys.version_info >= (3, 11):
+            return
+
+        source = Source(
+            '<matching_nodes_at_once>',
+            'def f(x, y):\n    return g(x.a, y.a), not x in y, x in y\n',
+        )
+        module_code = compile(source.text, source.filename, 'exec')
+        code = only(c for c in walk_codes(module_code) if c.co_name == 'f')
+        stmt = source.tree.body[0].body[0]
+
+        def matching(opname, index, node_type):
+            finder = SentinelNodeFinder.__new__(SentinelNodeFinder)
+            finder.tree = source.tree
+            finder.source = source
+            finder.code = code
+            finder.stmts = {stmt}
+            finder.is_pytest = False
+            finder.ignore_linenos = frozenset()
+            finder._compile_root = finder._compile_root_node = None
+
+            original_instructions = finder.get_original_clean_instructions()
+            original_index = [
+                i for i, inst in enumerate(original_instructions)
+                if inst.opname == opname
+            ][index]
+            finder.instruction = original_instructions[original_index]
+            exprs = [node for node in ast.walk(stmt) if isinstance(node, node_type)]
+            self.assertGreater(len(exprs), 1)
+
+            at_once = finder.matching_nodes_at_once(exprs, original_instructions, original_index)
+            # Force the fallback of compiling each candidate separately
+            finder.matching_nodes_at_once = lambda *args: None
+            return at_once, list(finder.matching_nodes(exprs))
+
+        # A single compilation for all the candidates
+        at_once, one_at_a_time = matching('LOAD_ATTR', 1, ast.Attribute)
+        self.assertEqual(len(at_once), 1)
+        self.assertIs(at_once[0], stmt.value.elts[0].args[1])
+        self.assertEqual(at_once, one_at_a_time)
+
+        if sys.version_info >= (3, 9):
+            # The sentinel changes 'not x in y' from CONTAINS_OP(invert=1) to CONTAINS_OP, UNARY_NOT,
+            # so the single compilation doesn't match the original instructions
+            at_once, one_at_a_time = matching('CONTAINS_OP', 0, ast.Compare)
+            self.assertIsNone(at_once)
+            self.assertEqual(one_at_a_time, [stmt.value.elts[1].operand])
+
+    def test_sentinel_finder_other_tree(self):
+        if sys.version_info >= (3, 11):
+            return
+
+        # e.g. an IPython cell, where each statement is compiled separately
+        # and the tree given to the finder isn't the source's tree
+        source = Source('<sentinel_finder_other_tree>', 'x = 1\ny = x.a + x.b(x.a)\n')
+        stmt = source.tree.body[1]
+        tree = wrap_in_module(stmt)
+        code = compile(tree, source.filename, 'exec')
+
+        def names(instructions):
+            return [(inst.opname, inst.argval) for inst in instructions]
+
+        for inst in get_instructions(code):
+            if inst.opname != 'LOAD_ATTR':
+                continue
+            frame = C()
+            frame.f_code = code
+            frame.f_lasti = inst.offset
+            frame.f_lineno = 2
+            frame.f_globals = {}
+            finder = SentinelNodeFinder(frame, {stmt}, tree, inst.offset, source)
+            self.assertIsInstance(finder.result, ast.Attribute)
+            self.assertEqual(finder.result.attr, inst.argval)
+            self.assertIsNone(finder._compile_root_node)
+            self.assertEqual(
+                names(finder.unmodified_instructions()),
+                names(finder.code_clean_instructions()),
+            )
+
+    def test_index_code_objects(self):
+        if sys.version_info < (3, 11):
+            return
+
+        class IndexingSource(Source):
+            index_code_objects = True
+
+        def func(x):
+            return foo(x.y) + [x][0].z  # noqa
+
+        code = func.__code__
+
+        def frame_at(inst):
+            frame = C()
+            frame.f_lasti = inst.offset
+            frame.f_code = code
+            frame.f_globals = globals()
+            frame.f_lineno = inst.positions.lineno
+            return frame
+
+        instructions = {inst.offset: inst for inst in dis.get_instructions(code)}
+        call = only(inst for inst in instructions.values() if inst.opname == "CALL")
+        self.assertIsInstance(IndexingSource.executing(frame_at(call)).node, ast.Call)
+
+        # All identifiable instructions were resolved by the first call
+        results = IndexingSource._executing_cache().get(code)
+        self.assertGreater(len(results), 5)
+        owner = None
+        for inst in dis.get_instructions(code, show_caches=True):
+            if inst.opname != 'CACHE':
+                owner = inst.offset
+            elif owner in results:
+                # CACHE entries share the results of their instruction
+                self.assertIs(results[inst.offset], results[owner])
+        for offset, (source, node, stmts, decorator) in results.items():
+            if offset not in instructions:
+                continue
+            frame = frame_at(instructions[offset])
+            self.assertIs(IndexingSource.executing(frame).node, node)
+            expected = Source.executing(frame)
+            self.assertEqual(
+                ast.dump(expected.node, include_attributes=True),
+                ast.dump(node, include_attributes=True),
+            )
+            self.assertEqual(
+                [ast.dump(stmt) for stmt in expected.statements],
+                [ast.dump(stmt) for stmt in stmts],
+            )
+
+    def test_index_code_objects_real_frame(self):
+        if sys.version_info < (3, 11):
+            return
+
+        offsets = []
+
+        class IndexingSource(Source):
+            index_code_objects = True
+
+            def _find_node(self, frame, stmts, lasti):
+                offsets.append(lasti)
+                return Source._find_node(self, frame, stmts, lasti)
+
+        def callee():
+            frame = inspect.currentframe().f_back
+            return frame.f_lasti, IndexingSource.executing(frame)
+
+        def func():
+            return [callee(), callee()]
+
+        results = func()
+        self.assertEqual(
+            [ex.text() for _, ex in results],
+            ['callee()', 'callee()'],
+        )
+
+        # A frame in the middle of a call is in the CACHE entries after the call,
+        # which were identified along with the call itself
+        instructions = {
+            inst.offset: inst
+            for inst in dis.get_instructions(func.__code__, show_caches=True)
+        }
+        for lasti, _ in results:
+            self.assertEqual(instructions[lasti].opname, 'CACHE')
+            self.assertNotIn(lasti, offsets)
+        self.assertEqual(len(offsets), len(set(offsets)))
+
+    def test_reload_releases_source(self):
+        fd, filename = tempfile.mkstemp(suffix='.py')
+        os.close(fd)
+        try:
+            text = 'def func():\n    return Source.executing(inspect.currentframe())\n'
+
+            def load(text):
+                # Imitates (re)loading a module from the file
+                with open(filename, 'w') as outfile:
+                    outfile.write(text)
+                namespace = dict(Source=Source, inspect=inspect)
+                exec(compile(text, filename, 'exec'), namespace)
+                return namespace['func']
+
+            ex = load(text)()
+            self.assertIsInstance(ex.node, ast.Call)
+            source_ref = weakref.ref(ex.source)
+            del ex
+
+            ex = load(text + '# changed\n')()
+            self.assertIsInstance(ex.node, ast.Call)
+            gc.collect()
+            self.assertIsNone(source_ref())
+        finally:
+            os.remove(filename)
+
+    def test_unique_filenames_release_sources(self):
+        class MySource(Source):
+            source_cache_size = 10
+
+        text = 'def func():\n    return MySource.executing(inspect.currentframe())\n'
+        refs = []
+        for i in range(50):
+            # e.g. exec'd plugins or templates
+            filename = '<unique_filename_%s>' % i
+            linecache.cache[filename] = (len(text), None, text.splitlines(True), filename)
+            namespace = dict(MySource=MySource, inspect=inspect)
+            exec(compile(text, filename, 'exec'), namespace)
+            ex = namespace['func']()
+            self.assertIsInstance(ex.node, ast.Call)
+            self.assertIs(MySource.for_filename(filename), ex.source)
+            refs.append(weakref.ref(ex.source))
+            del linecache.cache[filename], namespace, ex
+
+        gc.collect()
+        alive = [ref for ref in refs if ref() is not None]
+        self.assertEqual(alive, refs[-10:])
+
+    def test_statements_released_with_source(self):
+        source = Source('<statements>', ['x = (1 +\n', '     2)\n'])
+        stmt = only(source.statements_at_line(2))
+        self.assertIsInstance(stmt, ast.Assign)
+        self.assertEqual(source.statements_at_line(1), {stmt})
+        tree_ref = weakref.ref(source.tree)
+        del source, stmt
+        gc.collect()
+        self.assertIsNone(tree_ref())
+
+    def test_lazy_source(self):
+        source = Source('<lazy>', ['def foo():\n', '    x = 1\n'])
+        self.assertEqual(source.lines, ['def foo():', '    x = 1'])
+        self.assertNotIn('tree', source.__dict__)
+
+        code = compile(source.text, source.filename, 'exec').co_consts[0]
+        self.assertEqual(source.code_qualname(code), 'foo')
+        self.assertNotIn('tree', source.__dict__)
+        self.assertNotIn('_nodes_by_line', source.__dict__)
+
+        stmt = only(source.statements_at_line(2))
+        self.assertIsInstance(stmt, ast.Assign)
+        self.assertIs(stmt.parent, source.tree.body[0])
+
+        self.assertIsNone(Source('<lazy>', ['def']).tree)
+
     def test_many_source_for_filename_calls(self):
         source = None
         start = time.time()
@@ -294,6 +831,25 @@ class TestStuff(unittest.TestCase):
                 self.assertIs(source, new_source)
         self.assertLess(time.time() - start, 1)
 
+    def test_for_filename_linecache_reload(self):
+        filename = '<for_filename_linecache_reload>'
+        lines = ['x = 1\n']
+        linecache.cache[filename] = (1, None, lines, filename)
+        try:
+            source = Source.for_filename(filename)
+            self.assertIs(Source.for_filename(filename), source)
+
+            # Same contents in a new list, e.g. after checkcache reloaded the file
+            linecache.cache[filename] = (1, None, list(lines), filename)
+            self.assertIs(Source.for_filename(filename), source)
+
+            linecache.cache[filename] = (1, None, ['x = 2\n'], filename)
+            new_source = Source.for_filename(filename)
+            self.assertIsNot(new_source, source)
+            self.assertEqual(new_source.text, 'x = 2\n')
+        finally:
+            del linecache.cache[filename]
+
     def test_decode_source(self):
         def check(source, encoding, exception=None, matches=True):
             encoded = source.encode(encoding)
@@ -511,6 +1067,34 @@ class TestStuff(unittest.TestCase):
             self.assertTrue(isinstance(ex.node, ast.BinOp))
             self.assertEqual(ex.text(), "134895 / 0")
 
+    def test_executing_many(self):
+        def recurse(n):
+            if n:
+                return recurse(n - 1)
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                inputs = [sys.exc_info()[2]]
+                frame = inspect.currentframe().f_back
+                for _ in range(3):
+                    inputs.append(frame)
+                    frame = frame.f_back
+                result = Source.executing_many(inputs)
+                return result, [Source.executing(x) for x in inputs]
+
+        result, expected_result = recurse(2)
+        self.assertEqual(len(result), 4)
+        for ex, expected in zip(result, expected_result):
+            self.assertIs(ex.frame, expected.frame)
+            self.assertIs(ex.node, expected.node)
+            self.assertIs(ex.source, expected.source)
+
+        self.assertEqual(result[0].text(), "1 / 0")
+        self.assertEqual(result[1].text(), "recurse(n - 1)")
+        self.assertEqual(result[2].text(), "recurse(n - 1)")
+        self.assertEqual(result[3].text(), "recurse(2)")
+        self.assertEqual(Source.executing_many([]), [])
+
     def test_retry_cache(self):
         _, filename = tempfile.mkstemp()
 
@@ -524,6 +1108,407 @@ class TestStuff(unittest.TestCase):
         check(3)
         check(5)
 
+    def test_partial_parsing(self):
+        class MySource(Source):
+            partial_parsing = True
+
+        source = '''\
+def foo(x):
+    return ex(x)
+
+text = """
+def not_real():
+"""
+
+class A:
+    def method(self):
+        return [ex(y) for y in [1]][0]
+
+@dec
+def bar():
+    if 1:
+        pass
+    else:
+        pass
+    return ex(
+        ex)
+
+ex()
+foo(1)
+A().method()
+bar()
+'''
+        _, filename = tempfile.mkstemp()
+        with open(filename, 'w') as outfile:
+            outfile.write(source)
+
+        pairs = []
+
+        def ex(*_):
+            frame = inspect.currentframe().f_back
+            pairs.append((MySource.executing(frame), Source.executing(frame)))
+
+        try:
+            code = compile(source, filename, 'exec')
+            exec(code, {'ex': ex, 'dec': lambda f: f})
+        finally:
+            os.remove(filename)
+
+        self.assertEqual(len(pairs), 4)
+        full_source = MySource.for_filename(filename)
+        for partial, full in pairs:
+            self.assertEqual(ast.dump(partial.node), ast.dump(full.node))
+            self.assertEqual(partial.node.lineno, full.node.lineno)
+            self.assertEqual(partial.node.col_offset, full.node.col_offset)
+            self.assertEqual(partial.code_qualname(), full.code_qualname())
+            self.assertEqual(partial.text(), full.text())
+
+        self.assertIs(pairs[0][0].source, full_source)
+        for partial, _ in pairs[1:]:
+            self.assertIsNot(partial.source, full_source)
+            self.assertEqual(len(partial.source.tree.body), 1)
+            self.assertEqual(len(partial.source.lines), len(full_source.lines))
+        self.assertEqual(pairs[2][0].source.lines[7:10], full_source.lines[7:10])
+        self.assertEqual(pairs[2][0].source.lines[:7], [''] * 7)
+
+    def test_disk_cache(self):
+        cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+
+        class MySource(Source):
+            disk_cache_dir = cache_dir
+
+        class CachedSource(Source):
+            disk_cache_dir = cache_dir
+
+            def _find_node(self, frame, stmts, lasti):
+                raise AssertionError("Should have been loaded from the disk cache")
+
+        class QualnameSource(CachedSource):
+            pass
+
+        def ex():
+            frame = inspect.currentframe().f_back
+            return MySource.executing(frame), CachedSource.executing(frame)
+
+        def foo():
+            return ex()
+
+        try:
+            first, second = foo()
+            self.assertEqual(first.text(), 'ex()')
+            self.assertEqual(second.text(), 'ex()')
+            self.assertIsNot(first.node, second.node)
+            self.assertEqual(second.code_qualname(), first.code_qualname())
+
+            source = QualnameSource.for_filename(__file__)
+            self.assertEqual(
+                source.code_qualname(foo.__code__),
+                'TestStuff.test_disk_cache.<locals>.foo',
+            )
+            self.assertNotIn('_parsed_tree', source.__dict__)
+        finally:
+            shutil.rmtree(os.path.dirname(cache_dir))
+
+    def test_disk_cache_similar_code(self):
+        cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+
+        class MySource(Source):
+            disk_cache_dir = cache_dir
+
+        def ex(_):
+            return MySource.executing(inspect.currentframe().f_back).node
+
+        # Same line, name and bytecode
+        fs = (lambda x: ex(x.a)), (lambda x: ex(x.b))  # noqa
+        obj = C()
+        obj.a = obj.b = 1
+        try:
+            self.assertEqual(fs[0].__code__.co_code, fs[1].__code__.co_code)
+            for f, attr in zip(fs, 'ab'):
+                node = f(obj)
+                self.assertIsInstance(node, ast.Call)
+                self.assertEqual(node.args[0].attr, attr)
+        finally:
+            shutil.rmtree(os.path.dirname(cache_dir))
+
+        key = executing.executing.disk_cache_code_key
+        fs = (lambda: ex(1)), (lambda: ex(1.0)), (lambda: ex(True))  # noqa
+        self.assertEqual(len({key(f.__code__) for f in fs}), 3)
+
+    def test_disk_cache_malformed(self):
+        cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+        offsets = []
+
+        def make_source():
+            class MySource(Source):
+                disk_cache_dir = cache_dir
+
+                def _find_node(self, frame, stmts, lasti):
+                    offsets.append(lasti)
+                    return Source._find_node(self, frame, stmts, lasti)
+
+            return MySource
+
+        def ex(cls):
+            return cls.executing(inspect.currentframe().f_back)
+
+        source = 'def foo(cls, ex):\n    return ex(cls)\n'
+        _, filename = tempfile.mkstemp(suffix='.py')
+        try:
+            with open(filename, 'w') as outfile:
+                outfile.write(source)
+            namespace = {}
+            exec(compile(source, filename, 'exec'), namespace)
+            foo = namespace['foo']
+
+            self.assertEqual(foo(make_source(), ex).text(), 'ex(cls)')
+            save_disk_caches()
+            path = make_source().for_filename(filename)._disk_cache_path()
+            with open(path, 'rb') as f:
+                data = marshal.load(f)
+
+            def check(data, loaded):
+                with open(path, 'wb') as f:
+                    marshal.dump(data, f)
+                del offsets[:]
+                self.assertEqual(foo(make_source(), ex).text(), 'ex(cls)')
+                self.assertEqual(not offsets, loaded)
+
+            check(data, loaded=True)
+            check(dict(data, version=0), loaded=False)
+
+            # The Module node is index 0
+            for malformed in [(10 ** 6, None), (-1, None), (1, -1), (0, None), 'ab', None, 1]:
+                for results in data['codes'].values():
+                    for offset in results:
+                        results[offset] = malformed
+                check(data, loaded=False)
+        finally:
+            os.remove(filename)
+            shutil.rmtree(os.path.dirname(cache_dir))
+
+    def test_disk_cache_verification(self):
+        if sys.version_info < (3, 11):
+            return
+
+        cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+
+        class FastSource(Source):
+            disk_cache_dir = cache_dir
+            verification = "fast"
+
+        class FullSource(FastSource):
+            verification = "full"
+
+        class CachedSource(FastSource):
+            def _find_node(self, frame, stmts, lasti):
+                raise AssertionError("Should have been loaded from the disk cache")
+
+        def ex(cls):
+            return cls.executing(inspect.currentframe().f_back)
+
+        def foo(cls):
+            return ex(cls)
+
+        try:
+            # Less verified nodes aren't shared with other processes
+            self.assertEqual(foo(FastSource).text(), 'ex(cls)')
+            save_disk_caches()
+            self.assertFalse(os.path.exists(cache_dir))
+
+            # ...but fully verified ones are used by any process
+            self.assertEqual(foo(FullSource).text(), 'ex(cls)')
+            self.assertEqual(foo(CachedSource).text(), 'ex(cls)')
+        finally:
+            shutil.rmtree(os.path.dirname(cache_dir))
+
+    def test_disk_cache_partial_parsing(self):
+        cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+
+        class WriterSource(Source):
+            disk_cache_dir = cache_dir
+            partial_parsing = True
+
+        class CachedSource(WriterSource):
+            def _find_node(self, frame, stmts, lasti):
+                raise AssertionError("Should have been loaded from the disk cache")
+
+        source = 'def a(ex):\n    return ex(1)\n\ndef b(ex):\n    return ex(2)\n'
+        _, filename = tempfile.mkstemp(suffix='.py')
+        nodes = []
+
+        def writer_ex(_):
+            ex = WriterSource.executing(inspect.currentframe().f_back)
+            self.assertEqual(len(ex.source.tree.body), 1)
+            return 0
+
+        def cached_ex(_):
+            nodes.append(CachedSource.executing(inspect.currentframe().f_back).node)
+            return 0
+
+        try:
+            with open(filename, 'w') as outfile:
+                outfile.write(source)
+            namespace = {}
+            exec(compile(source, filename, 'exec'), namespace)
+
+            # Each region is stored separately rather than replacing the other's data
+            namespace['a'](writer_ex)
+            namespace['b'](writer_ex)
+            save_disk_caches()
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            namespace['a'](cached_ex)
+            namespace['b'](cached_ex)
+            self.assertEqual([node.args[0].n for node in nodes], [1, 2])
+        finally:
+            os.remove(filename)
+            shutil.rmtree(os.path.dirname(cache_dir))
+
+    def test_prewarm(self):
+        cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+        calls = []
+
+        class MySource(Source):
+            def _executing_args(self, frame, lineno, lasti):
+                calls.append(lasti)
+                return Source._executing_args(self, frame, lineno, lasti)
+
+        saves = []
+
+        class WriterSource(Source):
+            disk_cache_dir = cache_dir
+
+            def _save_disk_cache(self):
+                saves.append(self)
+                return Source._save_disk_cache(self)
+
+        class CachedSource(Source):
+            disk_cache_dir = cache_dir
+
+            def _find_node(self, frame, stmts, lasti):
+                raise AssertionError("Should have been loaded from the disk cache")
+
+        _, filename = tempfile.mkstemp(suffix='.py')
+        source = (
+            'class A(object):\n'
+            '    @staticmethod\n'
+            '    def foo(ex):\n'
+            '        return ex(1) + [ex(2)][0]\n'
+        )
+        module = types.ModuleType('prewarm_module')
+        module.__file__ = filename
+        nodes = []
+
+        def ex(_):
+            frame = inspect.currentframe().f_back
+            nodes.append((MySource.executing(frame).node, CachedSource.executing(frame).node))
+            return 0
+
+        try:
+            with open(filename, 'w') as outfile:
+                outfile.write(source)
+            exec(compile(source, filename, 'exec'), vars(module))
+
+            self.assertIsNone(MySource.prewarm([module]))
+            self.assertTrue(calls)
+            # Each instruction is identified once, not again for each of its CACHE entries
+            self.assertEqual(len(calls), len(set(calls)))
+            if sys.version_info >= (3, 11):
+                cache_offsets = {
+                    inst.offset
+                    for inst in dis.get_instructions(module.A.foo.__code__, show_caches=True)
+                    if inst.opname == 'CACHE'
+                }
+                self.assertFalse(cache_offsets & set(calls))
+            del calls[:]
+
+            # Compiles the file to store the results on disk
+            if PY3:
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor() as executor:
+                    futures = WriterSource.prewarm([filename], executor)
+                self.assertIsNone(only(futures).result())
+            else:
+                WriterSource.prewarm([filename])
+            # Not rewritten for every instruction
+            self.assertLessEqual(len(saves), 2)
+
+            module.A.foo(ex)
+            self.assertEqual(calls, [])
+            self.assertEqual([node.args[0].n for node, _ in nodes], [1, 2])
+            for node, cached_node in nodes:
+                self.assertEqual(ast.dump(node), ast.dump(cached_node))
+        finally:
+            os.remove(filename)
+            shutil.rmtree(os.path.dirname(cache_dir))
+
+    def test_lock_per_source(self):
+        _, filename = tempfile.mkstemp()
+        source = 'def foo(ex):\n    return ex(1) + ex(2)\n'
+        with open(filename, 'w') as outfile:
+            outfile.write(source)
+
+        namespace = {}
+        exec(compile(source, filename, 'exec'), namespace)
+        nodes = []
+
+        def ex(_):
+            nodes.append(Source.executing(inspect.currentframe().f_back).node)
+            return 0
+
+        # Resolving nodes in another file doesn't wait for this file's lock
+        thread = threading.Thread(target=namespace['foo'], args=(ex,))
+        try:
+            with Source.for_frame(inspect.currentframe())._lock:
+                thread.start()
+                thread.join(10)
+                self.assertEqual(len(nodes), 2)
+        finally:
+            thread.join()
+            os.remove(filename)
+        self.assertEqual([node.args[0].n for node in nodes], [1, 2])
+
+    def test_checkcache_interval(self):
+        class MySource(Source):
+            checkcache_interval = float('inf')
+
+        _, filename = tempfile.mkstemp()
+        try:
+            with open(filename, 'w') as outfile:
+                outfile.write('x = 1\n')
+            source = MySource.for_filename(filename)
+            self.assertEqual(source.text, 'x = 1\n')
+
+            with open(filename, 'w') as outfile:
+                outfile.write('x = 12\n')
+            self.assertIs(MySource.for_filename(filename), source)
+
+            MySource.invalidate(filename)
+            new_source = MySource.for_filename(filename)
+            self.assertIsNot(new_source, source)
+            self.assertEqual(new_source.text, 'x = 12\n')
+        finally:
+            os.remove(filename)
+            linecache.checkcache(filename)
+
+    def test_checkcache_times_bounded(self):
+        class MySource(Source):
+            checkcache_interval = float('inf')
+            source_cache_size = 3
+
+        for i in range(10):
+            filename = '<checkcache_%s>' % i
+            self.assertTrue(MySource._should_checkcache(filename))
+            self.assertFalse(MySource._should_checkcache(filename))
+        self.assertEqual(len(MySource.__dict__['__checkcache_times']), 3)
+
+        # Forgotten files are simply checked again
+        self.assertTrue(MySource._should_checkcache('<checkcache_0>'))
+        self.assertFalse(MySource._should_checkcache('<checkcache_9>'))
+        MySource.invalidate('<checkcache_9>')
+        self.assertTrue(MySource._should_checkcache('<checkcache_9>'))
+
     @contextlib.contextmanager
     def assert_name_error(self):
         try:
@@ -582,6 +1567,56 @@ class TestStuff(unittest.TestCase):
         def foo():
             pass
 
+    def test_decorator_calls(self):
+        if sys.version_info[:2] != (3, 11):
+            # PRECALL only exists in Python 3.11
+            return
+
+        filename = '<decorator_calls>'
+        lines = [
+            '@a\n',
+            '@b(c)\n',
+            'class X:\n',
+            '    @d.e\n',
+            '    def f(self): pass\n',
+            'x = g(h)\n',
+        ]
+        linecache.cache[filename] = (1, None, lines, filename)
+        try:
+            source = Source.for_filename(filename)
+            code = compile(source.text, filename, 'exec')
+            class_code = only(c for c in code.co_consts if isinstance(c, types.CodeType))
+
+            for inner_code in [code, class_code]:
+                results = {}
+                for inst in dis.get_instructions(inner_code):
+                    if inst.opname == 'CALL':
+                        frame = C()
+                        frame.f_code = inner_code
+                        frame.f_lasti = inst.offset
+                        frame.f_lineno = inst.positions.lineno
+                        frame.f_globals = {}
+                        ex = Source.executing(frame)
+                        self.assertIs(ex.source, source)
+                        if ex.decorator:
+                            results[inst.offset] = (ex.node, ex.decorator)
+
+                # Computed once for each code object, and the same as the results
+                self.assertEqual(source._decorator_calls.get(inner_code), results)
+
+            # Decorators are applied from the bottom up
+            class_x = source.tree.body[0]
+            self.assertEqual(
+                [pair for _, pair in sorted(source._decorator_calls.get(code).items())],
+                [(class_x, class_x.decorator_list[1]), (class_x, class_x.decorator_list[0])],
+            )
+            method_f = class_x.body[0]
+            self.assertEqual(
+                list(source._decorator_calls.get(class_code).values()),
+                [(method_f, method_f.decorator_list[0])],
+            )
+        finally:
+            del linecache.cache[filename]
 
 def is_unary_not(node):
     return isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not)